@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from .job_progress import JobProgress
 
 from .session import Session
+from .snapshot import JobSnapshot
 from . import states
 from . import backends
 
@@ -11,6 +12,7 @@ from . import backends
 __all__ = [
     'backends',
     'JobProgress',
+    'JobSnapshot',
     'Session',
     'states',
 ]
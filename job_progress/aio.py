@@ -0,0 +1,31 @@
+"""
+Asynchronous progress tracking, for Python 3.6+.
+
+Backend writes are run in the event loop's default executor, so that they
+do not block the loop.
+"""
+import asyncio
+
+from job_progress.tracking import ProgressTracker
+
+
+class AsyncProgressTracker(ProgressTracker):
+
+    """Like :class:`ProgressTracker`, over an asynchronous iterable."""
+
+    def __iter__(self):
+        raise TypeError("Use 'async for' with %s" % self.__class__.__name__)
+
+    async def __aiter__(self):
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._start)
+        completed = False
+        try:
+            async for item in self.iterable:
+                self._processing = True
+                yield item
+                if self._count():
+                    await loop.run_in_executor(None, self.flush)
+            completed = True
+        finally:
+            await loop.run_in_executor(None, self._finish, completed)
@@ -1,9 +1,17 @@
 from __future__ import absolute_import
-import redis
+import copy
+import itertools
+import os
+import threading
+import time
 import warnings
 
+import redis
+
 from job_progress import states
-from job_progress.cached_property import cached_property
+from job_progress.serializers import LazyData, get_serializer
+from job_progress.write_behind import (DELETE, PROGRESS, STATE,
+                                       WriteBehindQueue)
 
 JOB_LOG_PREFIX = "jobprogress"
 INDEX_SUFFIX = "index"
@@ -11,8 +19,204 @@ DEFAULT_SETTINGS = {
     "heartbeat_enabled": False,
     "heartbeat_expiration": 3600,  # in seconds
     "using_twemproxy": False,
-    "expiration": None
+    "expiration": None,
+    # Delete keys with UNLINK (Redis 4+) rather than DEL.
+    "use_unlink": False,
+    # Prefix of every key, indexes are partitioned per namespace.
+    "namespace": JOB_LOG_PREFIX,
+    # Connection pool
+    "max_connections": None,
+    "socket_timeout": None,  # in seconds
+    "socket_connect_timeout": None,  # in seconds
+    "socket_keepalive": None,
+    "health_check_interval": None,  # in seconds
+    "blocking_pool": False,
+    "pool_timeout": None,  # in seconds, only for blocking pools
+    # Read replicas
+    "replica_urls": (),
+    "replica_strategy": "round_robin",  # or "least_latency"
+    "replica_latency_interval": 5,  # in seconds
+    # Job data, see job_progress.serializers
+    "data_serializer": None,  # None (hash), "json" or "msgpack"
+    "compression_threshold": None,  # in bytes
+    # Transition log
+    "history_enabled": False,
+    "history_max_length": 100,
+    # Write-behind, see job_progress.write_behind. Writes are applied
+    # later, so reads may not see them yet.
+    "write_behind": False,
+    "write_behind_max_size": 10000,
+    "write_behind_spool_path": None,
+    "write_behind_interval": 0.1,  # in seconds
+    "write_behind_batch_size": 500,
+    # Tokens of idempotent increments remembered per job
+    "increment_tokens_max": 100,
+    "increment_tokens_ttl": 3600,  # in seconds
 }
+DATA_FIELDS = ("data", "amount", "state")
+# Keys stored for each job
+METADATA_NAMES = ("data", "progress", "amount", "state", "heartbeat",
+                  "history", "version", "tokens")
+REPLICA_STRATEGIES = frozenset(["round_robin", "least_latency"])
+POOL_SETTINGS = (
+    "max_connections",
+    "socket_timeout",
+    "socket_connect_timeout",
+    "socket_keepalive",
+    "health_check_interval",
+)
+
+# KEYS: expiry index, then the indexes to remove jobs from.
+# ARGV: now, batch size, then the names of the keys stored for each job.
+PRUNE_EXPIRED_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1],
+                           'LIMIT', 0, ARGV[2])
+for _, key in ipairs(expired) do
+    for i = 2, #KEYS do
+        redis.call('SREM', KEYS[i], key)
+    end
+    for i = 3, #ARGV do
+        redis.call('DEL', key .. ':' .. ARGV[i])
+    end
+    redis.call('ZREM', KEYS[1], key)
+end
+return #expired
+"""
+
+# KEYS: progress hash, tokens sorted set.
+# ARGV: token, now, max amount of tokens, tokens TTL, then states and counts.
+INCREMENT_ONCE_SCRIPT = """
+if redis.call('ZSCORE', KEYS[2], ARGV[1]) then
+    return 0
+end
+for i = 5, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[3]) - 1)
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+return 1
+"""
+
+# KEYS: scanned index, index of all jobs, then the state indexes.
+# ARGV: state of the scanned index ('' for all jobs), then the states of the
+# state indexes, in the same order, then the job keys.
+RECONCILE_SCRIPT = """
+local index_keys = {}
+for i = 3, #KEYS do
+    index_keys[ARGV[i - 1]] = KEYS[i]
+end
+local dangling, misplaced, missing = 0, 0, 0
+for i = #KEYS, #ARGV do
+    local key = ARGV[i]
+    local state = redis.call('GET', key .. ':state')
+    if not state then
+        dangling = dangling + 1
+        for j = 2, #KEYS do
+            redis.call('SREM', KEYS[j], key)
+        end
+    elseif index_keys[state] then
+        if ARGV[1] == '' then
+            missing = missing + redis.call('SADD', index_keys[state], key)
+        elseif state ~= ARGV[1] then
+            misplaced = misplaced + 1
+            redis.call('SREM', KEYS[1], key)
+            redis.call('SADD', index_keys[state], key)
+        end
+    end
+end
+return {dangling, misplaced, missing}
+"""
+
+# KEYS: index of the new state, then the indexes jobs may leave.
+# ARGV: new state, expiration (0 for none), then the states of the indexes
+# jobs may leave, in the same order, then the job keys.
+TRANSITION_SCRIPT = """
+local from = {}
+for i = 2, #KEYS do
+    from[ARGV[i + 2]] = KEYS[i]
+end
+local moved = {}
+for i = #KEYS + 3, #ARGV do
+    local key = ARGV[i]
+    local state = redis.call('GET', key .. ':state')
+    if state and from[state] then
+        -- The heartbeat goes first, so that started jobs are never staled.
+        if tonumber(ARGV[3]) > 0 then
+            redis.call('SETEX', key .. ':heartbeat', ARGV[3], 1)
+        end
+        if tonumber(ARGV[2]) > 0 then
+            redis.call('SETEX', key .. ':state', ARGV[2], ARGV[1])
+        else
+            redis.call('SET', key .. ':state', ARGV[1])
+        end
+        redis.call('SMOVE', from[state], KEYS[1], key)
+        moved[#moved + 1] = key
+    end
+end
+return moved
+"""
+
+_connection_pools = {}
+_connection_pools_pid = None
+_connection_pools_lock = threading.Lock()
+
+
+def encode_hash_values(mapping):
+    """Return ``mapping`` with values redis-py 3 rejects, like ``True`` or
+    ``None``, as strings, the way redis-py 2 stored them."""
+    return dict(
+        (key, value if isinstance(value, (bytes, type(u""), int, float)) and
+         not isinstance(value, bool) else str(value))
+        for key, value in mapping.items())
+
+
+def get_connection_pool(url, blocking=False, **options):
+    """Return a connection pool shared by the whole process.
+
+    Pools are keyed by URL and options, so that backends pointing at the
+    same server reuse connections. The registry is reset when the pid
+    changes, so that a forked child never shares its parent's sockets.
+
+    :param str url: Redis URL.
+    :param bool blocking: if ``True``, use a
+        :class:`redis.BlockingConnectionPool`.
+    :param options: connection pool options, ``None`` values are ignored.
+    """
+    global _connection_pools_pid
+
+    options = dict((k, v) for k, v in options.items() if v is not None)
+    key = (url, blocking, tuple(sorted(options.items())))
+
+    with _connection_pools_lock:
+        pid = os.getpid()
+        if _connection_pools_pid != pid:
+            _connection_pools.clear()
+            _connection_pools_pid = pid
+
+        pool = _connection_pools.get(key)
+        if pool is None:
+            if blocking:
+                pool_class = redis.BlockingConnectionPool
+            else:
+                pool_class = redis.ConnectionPool
+            pool = pool_class.from_url(url, **options)
+            _connection_pools[key] = pool
+
+    return pool
+
+
+def reset_connection_pools():
+    """Forget every shared connection pool.
+
+    The registry already resets itself after a fork, this is meant for
+    explicit hooks such as Celery's ``worker_process_init``.
+    """
+    global _connection_pools_pid
+
+    with _connection_pools_lock:
+        _connection_pools.clear()
+        _connection_pools_pid = None
 
 
 class RedisBackend(object):
@@ -27,10 +231,28 @@ class RedisBackend(object):
 
     def __init__(self, settings=None, get_client=None):
         self.settings = DEFAULT_SETTINGS.copy()
+        self.serializer = None
         if settings:
             self.update_settings(settings)
 
         self.get_client = get_client
+        self._client = None
+        self._client_pid = None
+        self._replicas = None
+        self._replicas_pid = None
+        self._replica_counter = itertools.count()
+        self._replica_latencies = None
+        self._replica_latencies_checked_at = 0
+        self._scripts = {}
+        self._write_behind = None
+        if self.settings.get("write_behind"):
+            self._write_behind = WriteBehindQueue(
+                self,
+                max_size=self.settings["write_behind_max_size"],
+                spool_path=self.settings["write_behind_spool_path"],
+                interval=self.settings["write_behind_interval"],
+                batch_size=self.settings["write_behind_batch_size"],
+            )
 
     def update_settings(self, settings):
         """Update the settings.
@@ -43,13 +265,103 @@ class RedisBackend(object):
             warnings.warn('Moving jobs between states with Twemproxy'
                           'is a non-atomic operation')
 
-    @cached_property
+        strategy = self.settings.get('replica_strategy')
+        if strategy not in REPLICA_STRATEGIES:
+            raise ValueError("Unknown replica_strategy: '%s'" % strategy)
+
+        self.serializer = get_serializer(
+            self.settings.get('data_serializer'),
+            self.settings.get('compression_threshold'))
+
+    @property
     def client(self):
-        """Return Redis client."""
-        if self.get_client:
-            return self.get_client()
+        """Return Redis client.
+
+        The client is created again if the process was forked since it was
+        last created, so that children do not use their parent's sockets.
+        """
+        pid = os.getpid()
+        if self._client is None or self._client_pid != pid:
+            if self.get_client:
+                self._client = self.get_client()
+            else:
+                self._client = self._create_client(
+                    self.settings["backend_url"])
+            self._client_pid = pid
+        return self._client
+
+    @client.setter  # noqa
+    def client(self, client):
+        """Set the Redis client."""
+        self._client = client
+        self._client_pid = os.getpid()
+
+    def for_namespace(self, namespace):
+        """Return a backend for ``namespace``, sharing this one's clients."""
+        backend = copy.copy(self)
+        backend.settings = dict(self.settings, namespace=namespace)
+        return backend
+
+    def _create_client(self, url):
+        """Return a new Redis client for ``url``."""
+        options = dict((name, self.settings.get(name))
+                       for name in POOL_SETTINGS)
+        blocking = self.settings.get("blocking_pool")
+        if blocking:
+            options["timeout"] = self.settings.get("pool_timeout")
+
+        pool = get_connection_pool(url, blocking=blocking, **options)
+        return redis.StrictRedis(connection_pool=pool)
+
+    @property
+    def replicas(self):
+        """Return the list of read replica clients."""
+        pid = os.getpid()
+        if self._replicas is None or self._replicas_pid != pid:
+            self._replicas = [self._create_client(url) for url
+                              in self.settings.get("replica_urls") or ()]
+            self._replicas_pid = pid
+            self._replica_latencies = None
+        return self._replicas
+
+    def get_read_client(self, primary=False):
+        """Return the client read-only operations should use.
+
+        :param bool primary: if ``True``, always return the primary client,
+            e.g. to read a job that was just written.
+        """
+        replicas = self.replicas
+        if primary or not replicas:
+            return self.client
+
+        if self.settings.get("replica_strategy") == "least_latency":
+            latencies = self._get_replica_latencies()
+            index = latencies.index(min(latencies))
         else:
-            return redis.StrictRedis.from_url(self.settings["backend_url"])
+            index = next(self._replica_counter) % len(replicas)
+        return replicas[index]
+
+    def _get_replica_latencies(self):
+        """Return replica latencies, measured at most once per interval."""
+        now = time.time()
+        interval = self.settings.get("replica_latency_interval")
+        if (self._replica_latencies is not None and
+                now - self._replica_latencies_checked_at < interval):
+            return self._replica_latencies
+
+        latencies = []
+        for replica in self.replicas:
+            started_at = time.time()
+            try:
+                replica.ping()
+            except redis.RedisError:
+                latencies.append(float("inf"))
+            else:
+                latencies.append(time.time() - started_at)
+
+        self._replica_latencies = latencies
+        self._replica_latencies_checked_at = now
+        return latencies
 
     def initialize_job(self, id_,
                        data, state, amount):
@@ -65,139 +377,658 @@ class RedisBackend(object):
             (client.sadd, self._get_key_for_index("all"), key),
             (client.sadd, self._get_key_for_index("state", state), key),
         ]
-        if data:
+        if data and self.serializer:
+            operations.append(
+                (client.set, self._get_metadata_key(key, "data"),
+                 self.serializer.dumps(data)))
+        elif data:
             operations.append(
-                (client.hmset, self._get_metadata_key(key, "data"), data))
+                (client.hmset, self._get_metadata_key(key, "data"),
+                 encode_hash_values(data)))
 
         for execute, key, value in operations:
             if execute == client.set and expiration:
                 client.setex(key, expiration, value)
+            elif execute == client.sadd:
+                # Index membership expires through prune_expired, expiring
+                # the index itself would drop every other job.
+                execute(key, value)
             else:
                 execute(key, value)
                 if expiration:
                     client.expire(key, expiration)
 
+        job_key = self._get_key_for_job_id(id_)
+        self._write_history(client, job_key, state)
+        self._write_version(client, job_key)
+        self._write_expiry(client, job_key)
+
         if not using_twemproxy:
             client.execute()
 
     def delete_job(self, id_, state):
         """Delete a job based on id."""
+        if self._write_behind is not None:
+            self._write_behind.put([DELETE, self.settings["namespace"], id_,
+                                    state])
+            return
+
         key = self._get_key_for_job_id(id_)
 
         using_twemproxy = self.settings.get('using_twemproxy')
         client = self.client.pipeline() if not using_twemproxy else self.client
 
-        client.delete(self._get_metadata_key(key, "data"))
-        client.delete(self._get_metadata_key(key, "progress"))
-        client.delete(self._get_metadata_key(key, "amount"))
-        client.delete(self._get_metadata_key(key, "state"))
-        client.delete(self._get_metadata_key(key, "heartbeat"))
+        self._write_delete(client, key, state)
+        if not using_twemproxy:
+            client.execute()
+
+    def _write_delete(self, client, key, state):
+        """Queue the deletion of a job on ``client``.
+
+        :param str state: state of the job, ``None`` if unknown.
+        """
+        for name in METADATA_NAMES:
+            client.delete(self._get_metadata_key(key, name))
+        if self.settings.get('expiration'):
+            client.zrem(self._get_key_for_index("expiry"), key)
         client.srem(self._get_key_for_index("all"), key)
-        client.srem(self._get_key_for_index("state", state), key)
+        for state_ in (states.ALL_STATES if state is None else [state]):
+            client.srem(self._get_key_for_index("state", state_), key)
+
+    def flush(self):
+        """Write the writes queued with ``write_behind``, if any."""
+        if self._write_behind is not None:
+            self._write_behind.drain()
+
+    def flush_changes(self, changes):
+        """Write queued changes in a single pipeline.
+
+        Unless using twemproxy, the pipeline is wrapped in MULTI/EXEC.
+
+        :param changes: a :class:`job_progress.unit_of_work.UnitOfWork`.
+        """
+        using_twemproxy = self.settings.get('using_twemproxy')
+        client = self.client.pipeline() if not using_twemproxy else self.client
+
+        for id_, state in changes.deletes.items():
+            self._write_delete(client, self._get_key_for_job_id(id_), state)
+
+        for id_, (previous_state, state, started) in \
+                changes.transitions.items():
+            key = self._get_key_for_job_id(id_)
+            if started and state != states.STARTED:
+                # The job went through STARTED in the meantime.
+                self.update_hearbeat(key, client)
+            self._write_state(client, key, state, previous_state)
+
+        for id_, counts in changes.increments.items():
+            key = self._get_key_for_job_id(id_)
+            if changes.token is not None:
+                self._write_progress_once(client, key, counts, changes.token)
+                continue
+            for state, count in counts.items():
+                self._write_progress(client, key, state, count)
+
+        if not using_twemproxy:
+            client.execute()
+
+    def set_amount(self, id_, amount):
+        """Set the amount of work of a given id."""
+        expiration = self.settings.get('expiration')
+        job_key = self._get_key_for_job_id(id_)
+        key = self._get_metadata_key(job_key, "amount")
+
+        using_twemproxy = self.settings.get('using_twemproxy')
+        client = self.client.pipeline() if not using_twemproxy else self.client
+
+        if expiration:
+            client.setex(key, expiration, amount)
+        else:
+            client.set(key, amount)
+        self._write_version(client, job_key)
         if not using_twemproxy:
             client.execute()
 
-    def get_data(self, id_):
-        """Return data for a given job."""
+    def get_data(self, id_, primary=False, fields=None):
+        """Return data for a given job.
+
+        :param str id_: job id.
+        :param bool primary: if ``True``, read from the primary.
+        :param fields: fields to return, among ``data``, ``amount``,
+            ``state`` and ``progress``. By default, return ``data``,
+            ``amount`` and ``state`` (also as ``previous_state``).
+        """
         key = self._get_key_for_job_id(id_)
-        client = self.client
+        requested = fields or DATA_FIELDS
+        pipeline = self.get_read_client(primary).pipeline(transaction=False)
+
+        for field in requested:
+            field_key = self._get_metadata_key(key, field)
+            if field == "data" and not self.serializer:
+                pipeline.hgetall(field_key)
+            elif field == "progress":
+                pipeline.hgetall(field_key)
+            elif field in DATA_FIELDS:
+                pipeline.get(field_key)
+            else:
+                raise TypeError("Unknown field: '%s'" % field)
+
+        values = dict(zip(requested, pipeline.execute()))
+
+        if "data" in values and self.serializer:
+            # Only deserialized if the data is actually accessed.
+            values["data"] = LazyData(values["data"], self.serializer)
+        if fields is None:
+            values["previous_state"] = values["state"]
+
+        return values
+
+    def get_snapshots(self, ids, primary=False, with_data=True,
+                      with_heartbeat_ages=False):
+        """Return the current values of many jobs, read in one pipeline.
 
-        data = client.hgetall(self._get_metadata_key(key, "data"))
-        amount = client.get(self._get_metadata_key(key, "amount"))
-        state = client.get(self._get_metadata_key(key, "state"))
+        :param list ids: job ids.
+        :param bool primary: if ``True``, read from the primary.
+        :param bool with_data: if ``False``, data is not read and is
+            returned as ``None``.
+        :param bool with_heartbeat_ages: if ``True``, the heartbeat age of
+            each job, see :meth:`get_heartbeat_ages`, ends its tuple.
+        :rtype: list of ``(id, state, amount, data, progress)`` tuples.
+        """
+        pipeline = self.get_read_client(primary).pipeline(transaction=False)
+
+        for id_ in ids:
+            key = self._get_key_for_job_id(id_)
+            pipeline.get(self._get_metadata_key(key, "state"))
+            pipeline.get(self._get_metadata_key(key, "amount"))
+            pipeline.hgetall(self._get_metadata_key(key, "progress"))
+            if with_data:
+                if self.serializer:
+                    pipeline.get(self._get_metadata_key(key, "data"))
+                else:
+                    pipeline.hgetall(self._get_metadata_key(key, "data"))
+            if with_heartbeat_ages:
+                pipeline.ttl(self._get_metadata_key(key, "heartbeat"))
+
+        values = iter(pipeline.execute())
+        snapshots = []
+        for id_ in ids:
+            state, amount, progress = next(values), next(values), next(values)
+            data = None
+            if with_data:
+                data = next(values)
+                if self.serializer:
+                    data = LazyData(data, self.serializer)
+            snapshot = (id_, state, amount, data, progress)
+            if with_heartbeat_ages:
+                snapshot += (self._get_heartbeat_age(next(values)),)
+            snapshots.append(snapshot)
 
-        return {
-            "data": data,
-            "amount": amount,
-            "state": state,
-            "previous_state": state,
-        }
+        return snapshots
 
     def add_one_progress_state(self, id_, state):
         """Add one unit state."""
-        expiration = self.settings.get('expiration')
-        job_key = self._get_key_for_job_id(id_)
+        if self._write_behind is not None:
+            self._write_behind.put([PROGRESS, self.settings["namespace"],
+                                    id_, state, 1])
+            return
+
+        using_twemproxy = self.settings.get('using_twemproxy')
+        client = (self.client.pipeline(transaction=False)
+                  if not using_twemproxy else self.client)
+
+        self._write_progress(client, self._get_key_for_job_id(id_), state, 1)
+        if not using_twemproxy:
+            client.execute()
+
+    def add_progress(self, id_, counts, token):
+        """Add progress counts, at most once per ``token``.
+
+        Tokens are remembered per job, the last ``increment_tokens_max``
+        ones for ``increment_tokens_ttl`` seconds, so that a write that
+        failed can be retried with the same token. Atomic unless using
+        twemproxy.
+
+        :param dict counts: amount of units per state.
+        :param str token: client generated token, see
+            :func:`job_progress.unit_of_work.new_token`.
+        :rtype: bool, ``False`` if the token was already applied.
+        """
+        key = self._get_key_for_job_id(id_)
+
+        using_twemproxy = self.settings.get('using_twemproxy')
+        client = self.client.pipeline() if not using_twemproxy else self.client
+
+        applied = self._write_progress_once(client, key, counts, token)
+        if not using_twemproxy:
+            applied = client.execute()[0]
+        return bool(applied)
+
+    def _write_progress_once(self, client, job_key, counts, token):
+        """Queue progress increments applied once per ``token``."""
+        progress_key = self._get_metadata_key(job_key, "progress")
+        tokens_key = self._get_metadata_key(job_key, "tokens")
+        max_tokens = self.settings["increment_tokens_max"]
+        tokens_ttl = self.settings["increment_tokens_ttl"]
+        now = time.time()
+
+        if not self.settings.get('using_twemproxy'):
+            args = [token, now, max_tokens, tokens_ttl]
+            for state, count in sorted(counts.items()):
+                args.extend((state, count))
+            applied = self._run_script(INCREMENT_ONCE_SCRIPT,
+                                       keys=[progress_key, tokens_key],
+                                       args=args, client=client)
+        elif client.zscore(tokens_key, token) is not None:
+            applied = 0
+        else:
+            # This is not an atomic operation.
+            for state, count in counts.items():
+                client.hincrby(progress_key, state, count)
+            client.execute_command("ZADD", tokens_key, now, token)
+            client.zremrangebyrank(tokens_key, 0, -max_tokens - 1)
+            client.expire(tokens_key, tokens_ttl)
+            applied = 1
+
+        self._write_progress_metadata(client, job_key)
+        return applied
+
+    def _write_progress(self, client, job_key, state, count):
+        """Queue a progress increment on ``client``."""
         key = self._get_metadata_key(job_key, "progress")
-        self.client.hincrby(key, state, 1)
+        client.hincrby(key, state, count)
+        self._write_progress_metadata(client, job_key)
+
+    def _write_progress_metadata(self, client, job_key):
+        """Queue what goes with progress increments on ``client``."""
+        expiration = self.settings.get('expiration')
         if expiration:
-            self.client.expire(key, expiration)
-        self.update_hearbeat(job_key)
+            client.expire(self._get_metadata_key(job_key, "progress"),
+                          expiration)
+        self.update_hearbeat(job_key, client)
+        self._write_version(client, job_key)
+        self._write_expiry(client, job_key)
 
-    def update_hearbeat(self, key):
+    def update_hearbeat(self, key, client=None):
         """Update the task's heartbeat."""
         if not self.settings.get('heartbeat_enabled'):
             return
-        self.client.setex(self._get_metadata_key(key, "heartbeat"),
-                          self.settings["heartbeat_expiration"],
-                          1)
+        if client is None:
+            client = self.client
+        client.setex(self._get_metadata_key(key, "heartbeat"),
+                     self.settings["heartbeat_expiration"],
+                     1)
+
+    def update_heartbeats(self, ids):
+        """Update the heartbeats of many jobs in one pipeline."""
+        if not self.settings.get('heartbeat_enabled') or not ids:
+            return
+        pipeline = self.client.pipeline(transaction=False)
+        for id_ in ids:
+            self.update_hearbeat(self._get_key_for_job_id(id_), pipeline)
+        pipeline.execute()
 
-    def get_progress(self, id_):
+    def get_progress(self, id_, primary=False):
         """Return progress."""
         key = self._get_key_for_job_id(id_)
         states_key = self._get_metadata_key(key, "progress")
-        return self.client.hgetall(states_key)
+        return self.get_read_client(primary).hgetall(states_key)
 
-    def get_state(self, id_):
+    def get_state(self, id_, primary=False):
         """Return state of a given id."""
         key = self._get_key_for_job_id(id_)
         state_key = self._get_metadata_key(key, "state")
-        return self.client.get(state_key)
+        return self.get_read_client(primary).get(state_key)
 
     def set_state(self, id_, state, previous_state=None):
         """Set state of a given id."""
+        if self._write_behind is not None:
+            self._write_behind.put([STATE, self.settings["namespace"], id_,
+                                    state, previous_state])
+            return
+
         key = self._get_key_for_job_id(id_)
+
+        using_twemproxy = self.settings.get('using_twemproxy')
+        client = self.client.pipeline() if not using_twemproxy else self.client
+
+        self._write_state(client, key, state, previous_state)
+        if not using_twemproxy:
+            client.execute()
+
+    def transition_jobs(self, ids, state, from_states):
+        """Move the jobs of ``ids`` to ``state`` if in ``from_states``.
+
+        Each job's state is checked and changed atomically, unless using
+        twemproxy, so that a job set to another state meanwhile is left
+        alone.
+
+        :rtype: list of the ids of the moved jobs.
+        """
+        if not ids:
+            return []
+        from_states = sorted(from_states)
+        keys = [self._get_key_for_job_id(id_) for id_ in ids]
+
+        if self.settings.get('using_twemproxy'):
+            moved = []
+            for key, current in zip(keys, self.client.mget(
+                    [self._get_metadata_key(k, "state") for k in keys])):
+                if current in from_states:
+                    # This is not an atomic operation
+                    self._write_state(self.client, key, state, current)
+                    moved.append(key)
+            return [self._get_id_for_key(key) for key in moved]
+
+        heartbeat_expiration = 0
+        if state == states.STARTED and \
+                self.settings.get('heartbeat_enabled'):
+            heartbeat_expiration = self.settings["heartbeat_expiration"]
+        moved = self._run_script(
+            TRANSITION_SCRIPT,
+            keys=[self._get_key_for_index("state", state)] + [
+                self._get_key_for_index("state", from_state)
+                for from_state in from_states],
+            args=[state, self.settings.get('expiration') or 0,
+                  heartbeat_expiration] + from_states + keys)
+
+        pipeline = self.client.pipeline(transaction=False)
+        for key in moved:
+            self._write_history(pipeline, key, state)
+            self._write_version(pipeline, key)
+            self._write_expiry(pipeline, key)
+        pipeline.execute()
+        return [self._get_id_for_key(key) for key in moved]
+
+    def _write_state(self, client, key, state, previous_state):
+        """Queue a state transition on ``client``."""
         expiration = self.settings.get('expiration')
 
         # The first thing we do is update the heartbeat to prevent any
         # race condition
         if state == states.STARTED:
-            self.update_hearbeat(key)
+            self.update_hearbeat(key, client)
 
         # First set the state
         state_key = self._get_metadata_key(key, "state")
         if expiration:
-            self.client.setex(state_key, expiration, state)
+            client.setex(state_key, expiration, state)
         else:
-            self.client.set(state_key, state)
+            client.set(state_key, state)
+
+        self._write_history(client, key, state)
+        self._write_version(client, key)
+        self._write_expiry(client, key)
 
         # The very last thing is updating the index
-        self.update_state_index(key, previous_state, state)
+        self.update_state_index(key, previous_state, state, client)
+
+    def _write_version(self, client, key):
+        """Queue bumping the version of a job, changed on every write."""
+        expiration = self.settings.get('expiration')
+        version_key = self._get_metadata_key(key, "version")
+        client.incr(version_key)
+        if expiration:
+            client.expire(version_key, expiration)
+
+    def get_versions(self, ids, primary=False):
+        """Return the versions of many jobs in one round trip.
+
+        A job's version changes whenever its state or progress does.
+        Versions are ``None`` for unknown jobs.
+        """
+        if not ids:
+            return []
+        keys = [self._get_metadata_key(self._get_key_for_job_id(id_),
+                                       "version") for id_ in ids]
+        return [int(version) if version is not None else None
+                for version in self.get_read_client(primary).mget(keys)]
+
+    def get_heartbeat_ages(self, ids, primary=False):
+        """Return the seconds since the last heartbeat of many jobs.
+
+        Ages are ``None`` for jobs without a live heartbeat.
+        """
+        if not ids:
+            return []
+        pipeline = self.get_read_client(primary).pipeline(transaction=False)
+        for id_ in ids:
+            pipeline.ttl(self._get_metadata_key(self._get_key_for_job_id(id_),
+                                                "heartbeat"))
+        return [self._get_heartbeat_age(ttl) for ttl in pipeline.execute()]
+
+    def _get_heartbeat_age(self, ttl):
+        """Return the age of a heartbeat from the TTL of its key."""
+        if ttl is None or ttl < 0:
+            return None
+        return self.settings["heartbeat_expiration"] - ttl
+
+    def _write_expiry(self, client, key):
+        """Queue pushing back the expiration of a job's index membership."""
+        expiration = self.settings.get('expiration')
+        if not expiration:
+            return
+        # Spelled out, as the signature of zadd differs between redis-py
+        # versions.
+        client.execute_command("ZADD", self._get_key_for_index("expiry"),
+                               time.time() + expiration, key)
+
+    def prune_expired(self, batch_size=1000, now=None):
+        """Remove expired jobs from the indexes, and delete their keys.
+
+        Jobs are tracked in a sorted set scored by expiration timestamp,
+        pushed back on every write. Expired jobs are removed by batches of
+        ``batch_size``, atomically unless using twemproxy.
+
+        :rtype: int, the amount of pruned jobs.
+        """
+        now = time.time() if now is None else now
+        expiry_key = self._get_key_for_index("expiry")
+        index_keys = [self._get_key_for_index("all")]
+        index_keys.extend(self._get_key_for_index("state", state)
+                          for state in sorted(states.ALL_STATES))
+
+        pruned = 0
+        while True:
+            if self.settings.get('using_twemproxy'):
+                count = self._prune_expired_batch(expiry_key, index_keys,
+                                                  batch_size, now)
+            else:
+                count = self._run_script(
+                    PRUNE_EXPIRED_SCRIPT,
+                    keys=[expiry_key] + index_keys,
+                    args=[now, batch_size] + list(METADATA_NAMES))
+            pruned += count
+            if count < batch_size:
+                return pruned
+
+    def _run_script(self, source, keys, args, client=None):
+        """Run a Lua script, by its SHA once the server knows it.
+
+        :param client: client or pipeline, defaults to the primary client.
+        """
+        if client is None:
+            client = self.client
+        script = self._scripts.get(source)
+        if script is None:
+            script = self._scripts[source] = self.client.register_script(
+                source)
+        return script(keys=keys, args=args, client=client)
+
+    def _prune_expired_batch(self, expiry_key, index_keys, batch_size, now):
+        """Prune a batch of expired jobs, without a script.
+
+        This is not atomic: a job written while being pruned loses its
+        index membership, which :meth:`reconcile_indexes` repairs.
+        """
+        keys = self.client.zrangebyscore(expiry_key, "-inf", now,
+                                         start=0, num=batch_size)
+        if not keys:
+            return 0
+
+        for key in keys:
+            for index_key in index_keys:
+                self.client.srem(index_key, key)
+            for name in METADATA_NAMES:
+                self.client.delete(self._get_metadata_key(key, name))
+        self.client.zrem(expiry_key, *keys)
+        return len(keys)
+
+    def _write_history(self, client, key, state):
+        """Queue an entry in the transition log on ``client``."""
+        if not self.settings.get('history_enabled'):
+            return
 
-    def update_state_index(self, key, previous_state, new_state):
-        """Update the state index."""
         expiration = self.settings.get('expiration')
+        history_key = self._get_metadata_key(key, "history")
+        client.rpush(history_key, "%f %s" % (time.time(), state))
+        client.ltrim(history_key, -self.settings["history_max_length"], -1)
+        if expiration:
+            client.expire(history_key, expiration)
+
+    def get_history(self, id_, primary=False):
+        """Return the transitions of a job, oldest first.
+
+        :rtype: list of ``(state, timestamp)`` tuples.
+        """
+        key = self._get_key_for_job_id(id_)
+        entries = self.get_read_client(primary).lrange(
+            self._get_metadata_key(key, "history"), 0, -1)
+
+        history = []
+        for entry in entries:
+            timestamp, state = entry.split(" ", 1)
+            history.append((state, float(timestamp)))
+        return history
+
+    def update_state_index(self, key, previous_state, new_state,
+                           client=None):
+        """Update the state index."""
+        if client is None:
+            client = self.client
         previous_state_key = self._get_key_for_index("state", previous_state)
         new_state_key = self._get_key_for_index("state", new_state)
 
         if previous_state:
             if not self.settings.get('using_twemproxy'):
                 # This is an atomic operation.
-                self.client.smove(previous_state_key, new_state_key, key)
+                client.smove(previous_state_key, new_state_key, key)
             else:
                 # This is not an atomic operation
-                self.client.srem(previous_state_key, key)
-                self.client.sadd(new_state_key, key)
+                client.srem(previous_state_key, key)
+                client.sadd(new_state_key, key)
         else:
-            self.client.sadd(new_state_key, key)
-        if expiration:
-            self.client.expire(new_state_key, expiration)
+            client.sadd(new_state_key, key)
+
+    def reconcile_indexes(self, batch_size=500, max_batches_per_second=None):
+        """Repair the indexes, a batch of members at a time.
+
+        - ids whose state key does not exist anymore (e.g. it expired) are
+          removed from every index,
+        - ids in the wrong state index are moved to the right one,
+        - ids missing from their state index are added to it.
+
+        :param int batch_size: amount of ids checked per round trip.
+        :param float max_batches_per_second: if set, sleep between batches
+            so as not to hurt production latency.
+        :rtype: dict with the amount of ``scanned``, ``dangling``,
+            ``misplaced`` and ``missing`` ids.
+        """
+        report = {"scanned": 0, "dangling": 0, "misplaced": 0, "missing": 0}
+        min_interval = 1.0 / max_batches_per_second \
+            if max_batches_per_second else 0
+
+        # State indexes first, so that misplaced ids are moved before the
+        # "all" index is checked for ids missing from their state index.
+        indexes = [(self._get_key_for_index("state", state), state)
+                   for state in sorted(states.ALL_STATES)]
+        indexes.append((self._get_key_for_index("all"), None))
+
+        for index_key, index_state in indexes:
+            cursor = None
+            while cursor != 0:
+                started_at = time.time()
+                cursor, keys = self.client.sscan(index_key, cursor or 0,
+                                                 count=batch_size)
+                if keys:
+                    self._reconcile_batch(index_key, index_state, list(keys),
+                                          report)
+
+                elapsed = time.time() - started_at
+                if elapsed < min_interval:
+                    time.sleep(min_interval - elapsed)
+
+        return report
+
+    def _reconcile_batch(self, index_key, index_state, keys, report):
+        """Repair a batch of members of an index.
+
+        States are checked and indexes fixed atomically, so that a job
+        changing state meanwhile is not put back in its former index.
+        """
+        report["scanned"] += len(keys)
+        if self.settings.get('using_twemproxy'):
+            self._reconcile_batch_without_script(index_key, index_state, keys,
+                                                 report)
+            return
+
+        index_states = sorted(states.ALL_STATES)
+        dangling, misplaced, missing = self._run_script(
+            RECONCILE_SCRIPT,
+            keys=[index_key, self._get_key_for_index("all")] + [
+                self._get_key_for_index("state", state)
+                for state in index_states],
+            args=[index_state or ""] + index_states + keys)
+        report["dangling"] += dangling
+        report["misplaced"] += misplaced
+        report["missing"] += missing
+
+    def _reconcile_batch_without_script(self, index_key, index_state, keys,
+                                        report):
+        """Repair a batch of members of an index, not atomically."""
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.get(self._get_metadata_key(key, "state"))
+        job_states = pipeline.execute()
 
-    def is_staled(self, id_):
+        # Positions of the SADDs whose result we count.
+        added_at = []
+        for key, state in zip(keys, job_states):
+            if state is None:
+                report["dangling"] += 1
+                pipeline.srem(self._get_key_for_index("all"), key)
+                for other_state in states.ALL_STATES:
+                    pipeline.srem(
+                        self._get_key_for_index("state", other_state), key)
+            elif index_state is None:
+                added_at.append(len(pipeline))
+                pipeline.sadd(self._get_key_for_index("state", state), key)
+            elif state != index_state:
+                report["misplaced"] += 1
+                pipeline.srem(index_key, key)
+                pipeline.sadd(self._get_key_for_index("state", state), key)
+        results = pipeline.execute()
+
+        report["missing"] += sum(results[index] for index in added_at)
+
+    def is_staled(self, id_, primary=False):
         """Return True if job at id_ is staled."""
         key = self._get_key_for_job_id(id_)
-        return not bool(self.client.exists(
+        return not bool(self.get_read_client(primary).exists(
             self._get_metadata_key(key, "heartbeat")
         ))
 
-    @classmethod
-    def _get_key_for_job_id(cls, id_):
+    def _get_key_for_job_id(self, id_):
         """Return a Redis key based on an id."""
-        return "{}:{}".format(JOB_LOG_PREFIX, id_)
+        return "{}:{}".format(self.settings["namespace"], id_)
 
-    @classmethod
-    def _get_key_for_index(cls, index_name, value=None):
+    def _get_id_for_key(self, key):
+        """Return the id of a job based on its Redis key."""
+        return key[len(self.settings["namespace"]) + 1:]
+
+    def _get_key_for_index(self, index_name, value=None):
         """Return a Redis key based on the index_name and value."""
-        return "{}:{}:{}:{}".format(JOB_LOG_PREFIX,
+        return "{}:{}:{}:{}".format(self.settings["namespace"],
                                     index_name,
                                     INDEX_SUFFIX,
                                     value)
@@ -211,9 +1042,10 @@ class RedisBackend(object):
         """
         return "{}:{}".format(key, name)
 
-    def get_ids(self, **filters):
+    def get_ids(self, primary=False, **filters):
         """Query the backend.
 
+        :param bool primary: if ``True``, read from the primary.
         :param filters: filters.
 
         Currently supported filters are:
@@ -222,6 +1054,8 @@ class RedisBackend(object):
         - ``state``
         """
 
+        client = self.get_read_client(primary)
+
         if filters:
             keys = []
 
@@ -238,7 +1072,7 @@ class RedisBackend(object):
                 # We need to get all the ids
 
                 if not self.settings.get('using_twemproxy'):
-                    keys.extend(self.client.sunion(
+                    keys.extend(client.sunion(
                         self._get_key_for_index("state", state)
                         for state in searched_states))
                 else:
@@ -246,7 +1080,7 @@ class RedisBackend(object):
                     ids = set()
 
                     for state in searched_states:
-                        ids.update(self.client.smembers(
+                        ids.update(client.smembers(
                             self._get_key_for_index("state", state)
                         ))
 
@@ -254,7 +1088,7 @@ class RedisBackend(object):
 
             if "state" in filters:
                 state = filters.pop("state")
-                keys.extend(self.client.smembers(
+                keys.extend(client.smembers(
                     self._get_key_for_index("state", state)))
 
             if filters:
@@ -262,6 +1096,153 @@ class RedisBackend(object):
 
         else:
             # Just get all keys
-            keys = self.client.smembers(self._get_key_for_index("all"))
+            keys = client.smembers(self._get_key_for_index("all"))
+
+        return [self._get_id_for_key(key) for key in keys]
+
+    def iter_ids(self, batch_size=1000, primary=False, **filters):
+        """Iterate over the ids matching ``filters`` by batches.
+
+        The indexes are walked with SSCAN, so that ids are never all held
+        in memory. Jobs changing state meanwhile may be returned twice, or
+        not at all. See :meth:`get_ids` for the supported filters.
+
+        :param int batch_size: amount of ids per batch, a hint to Redis.
+        :rtype: iterator of lists of ids.
+        """
+        client = self.get_read_client(primary)
+        for index_key in self._get_index_keys(filters):
+            cursor = None
+            while cursor != 0:
+                cursor, keys = client.sscan(index_key, cursor or 0,
+                                            count=batch_size)
+                if keys:
+                    yield [self._get_id_for_key(key) for key in keys]
+
+    def count(self, primary=False, **filters):
+        """Return the amount of jobs matching ``filters``.
+
+        This only reads the size of the indexes. See :meth:`get_ids` for
+        the supported filters.
+        """
+        pipeline = self.get_read_client(primary).pipeline(transaction=False)
+        for key in self._get_index_keys(filters):
+            pipeline.scard(key)
+        return sum(pipeline.execute())
+
+    def _get_index_keys(self, filters):
+        """Return the keys of the indexes matching ``filters``."""
+        keys = []
+        if "is_ready" in filters:
+            is_ready = filters.pop("is_ready")
+            if is_ready is False:
+                searched_states = states.NOT_READY_STATES
+            elif is_ready is True:
+                searched_states = states.READY_STATES
+            else:
+                raise TypeError("Unknown is_ready type: '%r'" % is_ready)
+            keys.extend(self._get_key_for_index("state", state)
+                        for state in searched_states)
+
+        if "state" in filters:
+            keys.append(self._get_key_for_index("state", filters.pop("state")))
+
+        if filters:
+            raise TypeError("Unknown filters: %s" % filters)
+
+        if not keys:
+            keys.append(self._get_key_for_index("all"))
+
+        return keys
+
+    def delete_jobs(self, ids, batch_size=1000):
+        """Delete jobs by batches, without reading them.
+
+        With ``write_behind``, the deletions are queued.
+
+        :rtype: int, the amount of deleted jobs.
+        """
+        ids = list(ids)
+        if self._write_behind is not None:
+            for id_ in ids:
+                self._write_behind.put([DELETE, self.settings["namespace"],
+                                        id_, None])
+            return len(ids)
+
+        for start in range(0, len(ids), batch_size):
+            self._delete_keys([self._get_key_for_job_id(id_)
+                               for id_ in ids[start:start + batch_size]])
+        return len(ids)
+
+    def delete_where(self, batch_size=1000, on_deleted=None, **filters):
+        """Delete the jobs matching ``filters``, without reading them.
+
+        The matching indexes are walked with SSCAN, and each batch of jobs
+        is deleted in one pipeline.
+
+        :param int batch_size: amount of jobs per batch.
+        :param function on_deleted: called with the ids of every deleted
+            batch.
+        :rtype: int, the amount of deleted jobs.
+        """
+        self.flush()
+        deleted = 0
+        for index_key in self._get_index_keys(filters):
+            cursor = None
+            while cursor != 0:
+                cursor, keys = self.client.sscan(index_key, cursor or 0,
+                                                 count=batch_size)
+                if not keys:
+                    continue
+                keys = list(keys)
+                self._delete_keys(keys)
+                deleted += len(keys)
+                if on_deleted is not None:
+                    on_deleted([self._get_id_for_key(key) for key in keys])
+        return deleted
+
+    def _delete_keys(self, keys):
+        """Delete jobs by key, and remove them from every index."""
+        pipeline = self.client.pipeline(transaction=False)
+
+        self._write_delete_metadata(pipeline, keys)
+        pipeline.srem(self._get_key_for_index("all"), *keys)
+        for state in states.ALL_STATES:
+            pipeline.srem(self._get_key_for_index("state", state), *keys)
+        if self.settings.get("expiration"):
+            pipeline.zrem(self._get_key_for_index("expiry"), *keys)
+
+        pipeline.execute()
+
+    def _write_delete_metadata(self, client, keys):
+        """Queue the deletion of the keys stored for each job of ``keys``."""
+        metadata_keys = [self._get_metadata_key(key, name)
+                         for key in keys for name in METADATA_NAMES]
+        if self.settings.get("use_unlink"):
+            # Memory is reclaimed in the background.
+            client.execute_command("UNLINK", *metadata_keys)
+        else:
+            client.delete(*metadata_keys)
+
+    def purge(self, batch_size=1000):
+        """Delete every job of the namespace, and its indexes.
+
+        :rtype: int, the amount of deleted jobs.
+        """
+        self.flush()
+        all_key = self._get_key_for_index("all")
+        deleted = 0
+        cursor = None
+        while cursor != 0:
+            cursor, keys = self.client.sscan(all_key, cursor or 0,
+                                             count=batch_size)
+            if keys:
+                self._write_delete_metadata(self.client, list(keys))
+            deleted += len(keys)
 
-        return [key.split(":")[1] for key in keys]
+        pipeline = self.client.pipeline(transaction=False)
+        pipeline.delete(all_key, self._get_key_for_index("expiry"))
+        for state in states.ALL_STATES:
+            pipeline.delete(self._get_key_for_index("state", state))
+        pipeline.execute()
+        return deleted
@@ -0,0 +1,538 @@
+from __future__ import absolute_import
+import atexit
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+
+from job_progress import states
+from job_progress.periodic import PeriodicThread
+from job_progress.serializers import LazyData, get_serializer
+from job_progress.unit_of_work import UnitOfWork
+
+DEFAULT_SETTINGS = {
+    "database": "job_progress.db",
+    "busy_timeout": 5,  # in seconds
+    "heartbeat_enabled": False,
+    "heartbeat_expiration": 3600,  # in seconds
+    # Progress increments are buffered and written in one transaction per
+    # interval, and at exit. 0 writes them immediately.
+    "write_batch_interval": 0,  # in seconds
+    "data_serializer": "json",
+    "compression_threshold": None,  # in bytes
+    "history_enabled": False,
+    "history_max_length": 100,
+}
+DATA_FIELDS = ("data", "amount", "state")
+# SQLite limits the amount of parameters of a statement.
+MAX_PARAMETERS = 500
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        state TEXT NOT NULL,
+        amount INTEGER,
+        data BLOB,
+        heartbeat REAL,
+        version INTEGER NOT NULL DEFAULT 1
+    )""",
+    "CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)",
+    "CREATE INDEX IF NOT EXISTS jobs_heartbeat ON jobs (heartbeat)",
+    """CREATE TABLE IF NOT EXISTS progress (
+        job_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (job_id, state)
+    )""",
+    """CREATE TABLE IF NOT EXISTS history (
+        job_id TEXT NOT NULL,
+        state TEXT NOT NULL,
+        timestamp REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS history_job_id ON history (job_id)",
+)
+
+# Statements are kept as constants so that the sqlite3 module's statement
+# cache always reuses the same prepared statements.
+INSERT_JOB = ("INSERT OR REPLACE INTO jobs (id, state, amount, data) "
+              "VALUES (?, ?, ?, ?)")
+DELETE_JOB = "DELETE FROM jobs WHERE id = ?"
+DELETE_PROGRESS = "DELETE FROM progress WHERE job_id = ?"
+DELETE_HISTORY = "DELETE FROM history WHERE job_id = ?"
+UPDATE_STATE = ("UPDATE jobs SET state = ?, version = version + 1 "
+                "WHERE id = ?")
+UPDATE_VERSION = "UPDATE jobs SET version = version + 1 WHERE id = ?"
+UPDATE_AMOUNT = ("UPDATE jobs SET amount = ?, version = version + 1 "
+                 "WHERE id = ?")
+UPDATE_HEARTBEAT = "UPDATE jobs SET heartbeat = ? WHERE id = ?"
+INSERT_PROGRESS = ("INSERT OR IGNORE INTO progress (job_id, state, count) "
+                   "VALUES (?, ?, 0)")
+INCREMENT_PROGRESS = ("UPDATE progress SET count = count + ? "
+                      "WHERE job_id = ? AND state = ?")
+INSERT_HISTORY = ("INSERT INTO history (job_id, state, timestamp) "
+                  "VALUES (?, ?, ?)")
+TRIM_HISTORY = ("DELETE FROM history WHERE job_id = ? AND rowid NOT IN "
+                "(SELECT rowid FROM history WHERE job_id = ? "
+                "ORDER BY rowid DESC LIMIT ?)")
+SELECT_JOB = "SELECT state, amount, data FROM jobs WHERE id = ?"
+SELECT_STATE = "SELECT state FROM jobs WHERE id = ?"
+SELECT_HEARTBEAT = "SELECT heartbeat FROM jobs WHERE id = ?"
+SELECT_PROGRESS = "SELECT state, count FROM progress WHERE job_id = ?"
+SELECT_HISTORY = ("SELECT state, timestamp FROM history WHERE job_id = ? "
+                  "ORDER BY rowid")
+
+
+class SQLiteBackend(object):
+
+    """
+    Store jobs in a SQLite database, for single host deployments.
+
+    The database uses WAL journaling, so that many worker processes of the
+    same machine can share it. Every thread of every process gets its own
+    connection.
+
+    The ``expiration`` setting of the Redis backend is not supported.
+
+    Increments buffered with ``write_batch_interval`` are written when the
+    interpreter exits. Processes exiting without running :mod:`atexit`
+    functions, like forked children calling :func:`os._exit`, must call
+    :meth:`flush` first.
+
+    :param dict settings: settings dictionnary
+
+    """
+
+    def __init__(self, settings=None):
+        self.settings = DEFAULT_SETTINGS.copy()
+        if settings:
+            self.settings.update(settings)
+
+        self.serializer = get_serializer(
+            self.settings["data_serializer"] or "json",
+            self.settings.get("compression_threshold"))
+
+        self._local = threading.local()
+        self._buffer = UnitOfWork()
+        self._buffer_lock = threading.Lock()
+        self._buffer_pid = os.getpid()
+        self._exit_registered = False
+        self._flusher = PeriodicThread(self.flush,
+                                       self.settings["write_batch_interval"],
+                                       name="job_progress-sqlite")
+        self._create_schema()
+
+    @property
+    def connection(self):
+        """Return the connection of the current thread and process."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.settings["database"],
+                timeout=self.settings["busy_timeout"],
+                isolation_level=None,
+                cached_statements=128,
+            )
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def _create_schema(self):
+        with self._transaction() as connection:
+            for statement in SCHEMA:
+                connection.execute(statement)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Return a context manager wrapping a write transaction."""
+        connection = self.connection
+        # Take the write lock right away, to avoid deadlocks between
+        # processes upgrading read locks.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        else:
+            connection.execute("COMMIT")
+
+    def close(self):
+        """Write buffered increments and close the current connection."""
+        self._flusher.stop()
+        self.flush()
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def flush(self):
+        """Write buffered progress increments in one transaction."""
+        with self._buffer_lock:
+            if self._buffer_pid != os.getpid():
+                # Those increments belong to the parent process.
+                self._buffer = UnitOfWork()
+                self._buffer_pid = os.getpid()
+            if not self._buffer:
+                return
+            buffered, self._buffer = self._buffer, UnitOfWork()
+
+        try:
+            self.flush_changes(buffered)
+        except Exception:
+            # The transaction was rolled back, keep the increments for the
+            # next try.
+            with self._buffer_lock:
+                for id_, counts in buffered.increments.items():
+                    for state, count in counts.items():
+                        self._buffer.increment(id_, state, count)
+            raise
+
+    def initialize_job(self, id_, data, state, amount):
+        """Initialize and store a job."""
+        payload = None
+        if data:
+            payload = sqlite3.Binary(self.serializer.dumps(data))
+
+        with self._transaction() as connection:
+            connection.execute(INSERT_JOB, (id_, state, amount, payload))
+            self._write_history(connection, id_, state)
+
+    def delete_job(self, id_, state):
+        """Delete a job based on id."""
+        with self._transaction() as connection:
+            self._write_delete(connection, id_)
+
+    def _write_delete(self, connection, id_):
+        with self._buffer_lock:
+            self._buffer.increments.pop(id_, None)
+        connection.execute(DELETE_JOB, (id_,))
+        connection.execute(DELETE_PROGRESS, (id_,))
+        connection.execute(DELETE_HISTORY, (id_,))
+
+    def delete_jobs(self, ids, batch_size=MAX_PARAMETERS):
+        """Delete jobs by batches, one transaction per batch.
+
+        :rtype: int, the amount of deleted jobs.
+        """
+        ids = list(ids)
+        batch_size = min(batch_size, MAX_PARAMETERS)
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            placeholders = ", ".join("?" * len(chunk))
+            with self._buffer_lock:
+                for id_ in chunk:
+                    self._buffer.increments.pop(id_, None)
+            with self._transaction() as connection:
+                connection.execute(
+                    "DELETE FROM jobs WHERE id IN (%s)" % placeholders, chunk)
+                for table in ("progress", "history"):
+                    connection.execute(
+                        "DELETE FROM %s WHERE job_id IN (%s)" % (
+                            table, placeholders), chunk)
+        return len(ids)
+
+    def delete_where(self, batch_size=MAX_PARAMETERS, on_deleted=None,
+                     **filters):
+        """Delete the jobs matching ``filters``.
+
+        :param int batch_size: amount of jobs per transaction.
+        :param function on_deleted: called with the ids of every deleted
+            batch.
+        :rtype: int, the amount of deleted jobs.
+        """
+        ids = self.get_ids(**filters)
+        batch_size = min(batch_size, MAX_PARAMETERS)
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            self.delete_jobs(chunk)
+            if on_deleted is not None:
+                on_deleted(chunk)
+        return len(ids)
+
+    def flush_changes(self, changes):
+        """Write queued changes in a single transaction.
+
+        Tokens of idempotent units of work are ignored: a transaction that
+        failed was rolled back, so it can be retried as is.
+
+        :param changes: a :class:`job_progress.unit_of_work.UnitOfWork`.
+        """
+        with self._transaction() as connection:
+            for id_ in changes.deletes:
+                self._write_delete(connection, id_)
+
+            for id_, (_, state, started) in changes.transitions.items():
+                if started and state != states.STARTED:
+                    self._write_heartbeat(connection, id_)
+                self._write_state(connection, id_, state)
+
+            for id_, counts in changes.increments.items():
+                for state, count in counts.items():
+                    self._write_progress(connection, id_, state, count)
+
+    def set_amount(self, id_, amount):
+        """Set the amount of work of a given id."""
+        with self._transaction() as connection:
+            connection.execute(UPDATE_AMOUNT, (amount, id_))
+
+    def get_data(self, id_, primary=False, fields=None):
+        """Return data for a given job.
+
+        :param str id_: job id.
+        :param bool primary: ignored, for compatibility.
+        :param fields: fields to return, among ``data``, ``amount``,
+            ``state`` and ``progress``. By default, return ``data``,
+            ``amount`` and ``state`` (also as ``previous_state``).
+        """
+        requested = fields or DATA_FIELDS
+        for field in requested:
+            if field not in DATA_FIELDS and field != "progress":
+                raise TypeError("Unknown field: '%s'" % field)
+
+        self.flush()
+        row = self.connection.execute(SELECT_JOB, (id_,)).fetchone()
+        state, amount, data = row or (None, None, None)
+
+        values = {
+            "state": state,
+            "amount": amount,
+            "data": LazyData(data and bytes(data), self.serializer),
+        }
+        if "progress" in requested:
+            values["progress"] = self.get_progress(id_)
+
+        values = dict((field, values[field]) for field in requested)
+        if fields is None:
+            values["previous_state"] = values["state"]
+        return values
+
+    def get_snapshots(self, ids, primary=False, with_data=True):
+        """Return the current values of many jobs.
+
+        :param list ids: job ids.
+        :param bool primary: ignored, for compatibility.
+        :param bool with_data: if ``False``, data is returned as ``None``.
+        :rtype: list of ``(id, state, amount, data, progress)`` tuples.
+        """
+        self.flush()
+        connection = self.connection
+        jobs = {}
+        progress = dict((id_, {}) for id_ in ids)
+
+        for start in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[start:start + MAX_PARAMETERS]
+            placeholders = ", ".join("?" * len(chunk))
+            columns = "id, state, amount, data" if with_data else \
+                "id, state, amount, NULL"
+            for id_, state, amount, data in connection.execute(
+                    "SELECT %s FROM jobs WHERE id IN (%s)" % (
+                        columns, placeholders), chunk):
+                jobs[id_] = (state, amount, data)
+            for id_, state, count in connection.execute(
+                    "SELECT job_id, state, count FROM progress "
+                    "WHERE job_id IN (%s)" % placeholders, chunk):
+                progress[id_][state] = count
+
+        snapshots = []
+        for id_ in ids:
+            state, amount, data = jobs.get(id_, (None, None, None))
+            if with_data:
+                data = LazyData(data and bytes(data), self.serializer)
+            snapshots.append((id_, state, amount, data, progress[id_]))
+        return snapshots
+
+    def get_versions(self, ids, primary=False):
+        """Return the versions of many jobs.
+
+        A job's version changes whenever its state or progress does.
+        Versions are ``None`` for unknown jobs.
+        """
+        self.flush()
+        versions = {}
+        for start in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[start:start + MAX_PARAMETERS]
+            versions.update(self.connection.execute(
+                "SELECT id, version FROM jobs WHERE id IN (%s)" % ", ".join(
+                    "?" * len(chunk)), chunk))
+        return [versions.get(id_) for id_ in ids]
+
+    def add_one_progress_state(self, id_, state):
+        """Add one unit state.
+
+        With ``write_batch_interval``, the increment is buffered.
+        """
+        if not self.settings["write_batch_interval"]:
+            with self._transaction() as connection:
+                self._write_progress(connection, id_, state, 1)
+            return
+
+        with self._buffer_lock:
+            self._buffer.increment(id_, state)
+        self._start()
+
+    def _start(self):
+        """Write buffered increments in the background, and at exit."""
+        self._flusher.start()
+        if not self._exit_registered:
+            # Forked children inherit the registration.
+            self._exit_registered = True
+            atexit.register(self.flush)
+
+    def _write_progress(self, connection, id_, state, count):
+        connection.execute(INSERT_PROGRESS, (id_, state))
+        connection.execute(INCREMENT_PROGRESS, (count, id_, state))
+        connection.execute(UPDATE_VERSION, (id_,))
+        self._write_heartbeat(connection, id_)
+
+    def _write_heartbeat(self, connection, id_):
+        if not self.settings.get("heartbeat_enabled"):
+            return
+        expires_at = time.time() + self.settings["heartbeat_expiration"]
+        connection.execute(UPDATE_HEARTBEAT, (expires_at, id_))
+
+    def update_heartbeats(self, ids):
+        """Update the heartbeats of many jobs in one transaction."""
+        if not self.settings.get("heartbeat_enabled") or not ids:
+            return
+        with self._transaction() as connection:
+            for id_ in ids:
+                self._write_heartbeat(connection, id_)
+
+    def get_progress(self, id_, primary=False):
+        """Return progress."""
+        self.flush()
+        return dict(self.connection.execute(SELECT_PROGRESS, (id_,)))
+
+    def get_state(self, id_, primary=False):
+        """Return state of a given id."""
+        row = self.connection.execute(SELECT_STATE, (id_,)).fetchone()
+        return row[0] if row else None
+
+    def set_state(self, id_, state, previous_state=None):
+        """Set state of a given id."""
+        with self._transaction() as connection:
+            if state == states.STARTED:
+                self._write_heartbeat(connection, id_)
+            self._write_state(connection, id_, state)
+
+    def transition_jobs(self, ids, state, from_states):
+        """Move the jobs of ``ids`` to ``state`` if in ``from_states``.
+
+        Jobs are checked and moved in one transaction.
+
+        :rtype: list of the ids of the moved jobs.
+        """
+        moved = []
+        from_states = list(from_states)
+        with self._transaction() as connection:
+            for start in range(0, len(ids), MAX_PARAMETERS - len(from_states)):
+                chunk = ids[start:start + MAX_PARAMETERS - len(from_states)]
+                moved.extend(id_ for id_, in connection.execute(
+                    "SELECT id FROM jobs WHERE id IN (%s) AND state IN (%s)" %
+                    (", ".join("?" * len(chunk)),
+                     ", ".join("?" * len(from_states))),
+                    chunk + from_states))
+            for id_ in moved:
+                if state == states.STARTED:
+                    self._write_heartbeat(connection, id_)
+                self._write_state(connection, id_, state)
+        return moved
+
+    def _write_state(self, connection, id_, state):
+        connection.execute(UPDATE_STATE, (state, id_))
+        self._write_history(connection, id_, state)
+
+    def _write_history(self, connection, id_, state):
+        if not self.settings.get("history_enabled"):
+            return
+        connection.execute(INSERT_HISTORY, (id_, state, time.time()))
+        connection.execute(TRIM_HISTORY,
+                           (id_, id_, self.settings["history_max_length"]))
+
+    def get_history(self, id_, primary=False):
+        """Return the transitions of a job, oldest first.
+
+        :rtype: list of ``(state, timestamp)`` tuples.
+        """
+        return list(self.connection.execute(SELECT_HISTORY, (id_,)))
+
+    def is_staled(self, id_, primary=False):
+        """Return True if job at id_ is staled."""
+        self.flush()
+        row = self.connection.execute(SELECT_HEARTBEAT, (id_,)).fetchone()
+        return not row or row[0] is None or row[0] < time.time()
+
+    def get_heartbeat_ages(self, ids, primary=False):
+        """Return the seconds since the last heartbeat of many jobs.
+
+        Ages are ``None`` for jobs without a live heartbeat.
+        """
+        self.flush()
+        now = time.time()
+        expiration = self.settings["heartbeat_expiration"]
+        heartbeats = {}
+        for start in range(0, len(ids), MAX_PARAMETERS):
+            chunk = ids[start:start + MAX_PARAMETERS]
+            heartbeats.update(self.connection.execute(
+                "SELECT id, heartbeat FROM jobs WHERE id IN (%s)" % ", ".join(
+                    "?" * len(chunk)), chunk))
+        ages = []
+        for id_ in ids:
+            heartbeat = heartbeats.get(id_)
+            if heartbeat is None or heartbeat < now:
+                ages.append(None)
+            else:
+                ages.append(expiration - (heartbeat - now))
+        return ages
+
+    def get_ids(self, primary=False, **filters):
+        """Query the backend.
+
+        :param bool primary: ignored, for compatibility.
+        :param filters: filters.
+
+        Currently supported filters are:
+
+        - ``is_ready``
+        - ``state``
+        """
+        return [id_ for id_, in self._select("id", filters)]
+
+    def count(self, primary=False, **filters):
+        """Return the amount of jobs matching ``filters``.
+
+        See :meth:`get_ids` for the supported filters.
+        """
+        return self._select("COUNT(*)", filters).fetchone()[0]
+
+    def _select(self, columns, filters):
+        """Return a cursor over ``columns`` of jobs matching ``filters``."""
+        searched_states = set()
+
+        if "is_ready" in filters:
+            is_ready = filters.pop("is_ready")
+
+            if is_ready is False:
+                searched_states.update(states.NOT_READY_STATES)
+            elif is_ready is True:
+                searched_states.update(states.READY_STATES)
+            else:
+                raise TypeError("Unknown is_ready type: '%r'" % is_ready)
+
+        if "state" in filters:
+            searched_states.add(filters.pop("state"))
+
+        if filters:
+            raise TypeError("Unknown filters: %s" % filters)
+
+        if not searched_states:
+            return self.connection.execute("SELECT %s FROM jobs" % columns)
+
+        # Served by the jobs_state index.
+        return self.connection.execute(
+            "SELECT %s FROM jobs WHERE state IN (%s)" % (
+                columns, ", ".join("?" * len(searched_states))),
+            sorted(searched_states))
@@ -0,0 +1,158 @@
+"""
+Celery integration: task signals drive job progress.
+
+Each task carrying a job id is one unit of the job's work::
+
+    integration = CeleryIntegration(session)
+    integration.connect()
+
+    toast.delay(bread, job_progress_id=job.id)
+
+- When a worker process first runs a task of a job, the job is moved to
+  STARTED if it was PENDING or SCHEDULED.
+- Successful, failed and revoked tasks add one SUCCESS, FAILURE or REVOKED
+  unit.
+
+Events are buffered per worker process and written every ``interval``
+seconds in one pipeline, so tasks never wait on the backend. Setting the
+job's final state is left to the caller, e.g. a chord callback.
+"""
+from __future__ import absolute_import
+import threading
+
+from job_progress import states
+from job_progress.periodic import PeriodicThread
+from job_progress.unit_of_work import UnitOfWork
+
+JOB_ID_KWARG = "job_progress_id"
+MAX_SEEN_JOBS = 10000
+
+
+def get_job_id_from_kwargs(args, kwargs):
+    """Return the ``job_progress_id`` keyword argument of a task."""
+    return (kwargs or {}).get(JOB_ID_KWARG)
+
+
+class CeleryIntegration(object):
+
+    """
+    Map Celery task signals to batched job progress updates.
+
+    :param Session session:
+    :param float interval: interval in seconds between writes.
+    :param function get_job_id: return the job id of a task from its
+        ``args`` and ``kwargs``, ``None`` if it does not belong to a job.
+    """
+
+    def __init__(self, session, interval=0.5,
+                 get_job_id=get_job_id_from_kwargs):
+        self.session = session
+        self.get_job_id = get_job_id
+        self._buffer = UnitOfWork(idempotent=True)
+        self._started = set()
+        self._seen = set()
+        self._tasks = {}
+        self._lock = threading.Lock()
+        #: unit of work whose flush failed, retried first
+        self._failed = None
+        self._flusher = PeriodicThread(self.flush, interval,
+                                       name="job_progress-celery")
+
+    def connect(self):
+        """Connect to Celery signals."""
+        from celery import signals
+
+        signals.task_prerun.connect(self.on_task_prerun, weak=False)
+        signals.task_postrun.connect(self.on_task_postrun, weak=False)
+        signals.task_success.connect(self.on_task_success, weak=False)
+        signals.task_failure.connect(self.on_task_failure, weak=False)
+        signals.task_revoked.connect(self.on_task_revoked, weak=False)
+        signals.worker_process_shutdown.connect(self.on_worker_shutdown,
+                                                weak=False)
+        signals.worker_shutdown.connect(self.on_worker_shutdown, weak=False)
+
+    def on_task_prerun(self, task_id=None, args=None, kwargs=None, **extra):
+        """Remember the job of the task, start the job if needed."""
+        job_id = self.get_job_id(args, kwargs)
+        if job_id is None:
+            return
+
+        with self._lock:
+            self._tasks[task_id] = job_id
+            if job_id not in self._seen:
+                if len(self._seen) >= MAX_SEEN_JOBS:
+                    # Forgetting only costs a state read.
+                    self._seen.clear()
+                self._seen.add(job_id)
+                self._started.add(job_id)
+        self._flusher.start()
+
+    def on_task_postrun(self, task_id=None, **extra):
+        """Forget the job of the task."""
+        with self._lock:
+            self._tasks.pop(task_id, None)
+
+    def on_task_success(self, sender=None, **extra):
+        """Add one SUCCESS unit."""
+        self._increment(self._tasks.get(sender.request.id), states.SUCCESS)
+
+    def on_task_failure(self, task_id=None, **extra):
+        """Add one FAILURE unit."""
+        self._increment(self._tasks.get(task_id), states.FAILURE)
+
+    def on_task_revoked(self, request=None, **extra):
+        """Add one REVOKED unit."""
+        job_id = self._tasks.get(request.id)
+        if job_id is None:
+            # The task may be revoked before it runs.
+            job_id = self.get_job_id(getattr(request, "args", None),
+                                     getattr(request, "kwargs", None))
+        self._increment(job_id, states.REVOKED)
+
+    def on_worker_shutdown(self, **extra):
+        """Write what's left."""
+        self._flusher.stop()
+        self.flush()
+
+    def _increment(self, job_id, state):
+        if job_id is None:
+            return
+        with self._lock:
+            self._buffer.increment(job_id, state)
+        self._flusher.start()
+
+    def flush(self):
+        """Write buffered events in one pipeline.
+
+        Events that failed to be written are written again first, with the
+        same token, so that they are not counted twice.
+        """
+        backend = self.session.backend
+        if self._failed is not None:
+            self._failed.flush(backend)
+            self._failed = None
+
+        with self._lock:
+            buffer, self._buffer = self._buffer, UnitOfWork(idempotent=True)
+            started, self._started = self._started, set()
+
+        try:
+            if started:
+                # Only jobs that did not start yet are moved, each one
+                # atomically, so that a job finished meanwhile stays so.
+                backend.transition_jobs(sorted(started), states.STARTED,
+                                        states.REVOKABLE_STATES)
+        except Exception:
+            # Keep the events for the next try.
+            with self._lock:
+                self._started.update(started)
+                for id_, counts in buffer.increments.items():
+                    for state, count in counts.items():
+                        self._buffer.increment(id_, state, count)
+            raise
+
+        try:
+            buffer.flush(backend)
+        except Exception:
+            self._failed = buffer
+            raise
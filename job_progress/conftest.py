@@ -0,0 +1,6 @@
+import sys
+
+collect_ignore = []
+if sys.version_info < (3, 6):
+    # Asynchronous generators are a syntax error.
+    collect_ignore = ["aio.py", "tests/test_aio.py"]
@@ -0,0 +1,82 @@
+"""
+Heartbeats refreshed in the background for long-running jobs.
+
+A single thread per process refreshes the heartbeats of every registered
+job, with one pipeline per backend and tick. See
+:meth:`job_progress.JobProgress.run`.
+"""
+from __future__ import absolute_import
+import os
+import threading
+
+from job_progress.periodic import PeriodicThread
+
+
+class Heartbeats(object):
+
+    """Registry of jobs whose heartbeat is refreshed in the background."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Held while heartbeats are written.
+        self._beat_lock = threading.Lock()
+        self._pid = os.getpid()
+        #: backend -> {id: interval}
+        self._jobs = {}
+        self._thread = PeriodicThread(self.beat, None,
+                                      name="job_progress-heartbeat")
+
+    def _check_pid(self):
+        """Forget the parent's jobs after a fork."""
+        if self._pid != os.getpid():
+            self._jobs = {}
+            self._pid = os.getpid()
+
+    def register(self, backend, id_, interval):
+        """Refresh the heartbeat of a job every ``interval`` seconds.
+
+        Heartbeats are refreshed at the smallest registered interval.
+        """
+        with self._lock:
+            self._check_pid()
+            self._jobs.setdefault(backend, {})[id_] = interval
+            self._thread.interval = self._get_interval()
+            self._thread.start()
+
+    def unregister(self, backend, id_):
+        """Stop refreshing the heartbeat of a job.
+
+        Returns once a beat in progress is over, so that the heartbeat is
+        not written after the job is closed, e.g. deleted.
+        """
+        with self._lock:
+            self._check_pid()
+            jobs = self._jobs.get(backend, {})
+            jobs.pop(id_, None)
+            if not jobs:
+                self._jobs.pop(backend, None)
+
+            if self._jobs:
+                self._thread.interval = self._get_interval()
+            else:
+                self._thread.stop(wait=False)
+
+        with self._beat_lock:
+            pass
+
+    def _get_interval(self):
+        return min(min(jobs.values()) for jobs in self._jobs.values())
+
+    def beat(self):
+        """Refresh every registered heartbeat."""
+        with self._beat_lock:
+            with self._lock:
+                self._check_pid()
+                jobs = [(backend, list(ids)) for backend, ids
+                        in self._jobs.items()]
+
+            for backend, ids in jobs:
+                backend.update_heartbeats(ids)
+
+
+heartbeats = Heartbeats()
@@ -2,7 +2,15 @@ from __future__ import absolute_import
 import uuid
 
 from job_progress import states
-from job_progress.utils import classproperty
+from job_progress.heartbeat import heartbeats
+from job_progress.reporter import ProgressReporter
+from job_progress.tracking import ProgressTracker
+from job_progress.serializers import LazyData
+from job_progress.utils import (compute_durations, compute_progress,
+                                hybridproperty)
+
+# Marks a field that has not been loaded from the backend yet.
+UNLOADED = object()
 
 
 def _generate_id():
@@ -21,33 +29,45 @@ class JobProgress(object):
     :param str state: state the job starts with
     :param str previous_state:
     :param bool loading:
+    :param Session session: session the job belongs to, defaults to the
+        class session.
 
     """
 
     session = None
 
     def __init__(self, data=None, amount=1, id_=None, state=states.PENDING,
-                 previous_state=states.PENDING, loading=False):
+                 previous_state=states.PENDING, loading=False, session=None):
+        if session is not None:
+            self.session = session
         self.data = data or {}
         self.amount = amount
         self._previous_state = previous_state
         self.id = id_ or _generate_id()
         self.delete_on_closing = False
+        self.heartbeat_interval = None
 
         if not loading:
             # Store in the back-end
             self.backend.initialize_job(self.id, self.data, state,
                                         self.amount)
             self.session.add(self.id, self)
+            self.session.pin(self.id)
 
     def __repr__(self):
         """Return repr of the object."""
         return "<%s '%s'>" % (self.__class__.__name__, self.id)
 
     @classmethod
-    def from_backend(cls, data, amount, id_, state, previous_state):
-        """Load from backend."""
-        self = cls(data, amount, id_, state, previous_state, loading=True)
+    def from_backend(cls, data=UNLOADED, amount=UNLOADED, id_=None,
+                     state=None, previous_state=UNLOADED, session=None):
+        """Load from backend.
+
+        Fields left ``UNLOADED`` are fetched from the backend when first
+        accessed.
+        """
+        self = cls(data, amount, id_, state, previous_state, loading=True,
+                   session=session)
         return self
 
     @classmethod
@@ -64,18 +84,65 @@ class JobProgress(object):
         This method should be considered alpha.
         """
 
-        ids = cls.backend.get_ids(**filters)
-        return [cls.session.get(id_) for id_ in ids]
+        return cls.session.query(**filters)
 
     @classmethod
     def set_session(cls, session):
         """Set the session."""
         cls.session = session
 
-    @classproperty
-    def backend(cls):
+    @hybridproperty
+    def backend(self_or_cls):
         """Return backend instance."""
-        return cls.session.backend
+        return self_or_cls.session.backend
+
+    @property
+    def _read_from_primary(self):
+        """Return True if reads must go to the primary (read-your-writes)."""
+        return self.session.is_pinned(self.id)
+
+    def _hydrate(self, *fields):
+        """Load ``fields`` from the backend in one round trip.
+
+        Only ``data`` and ``amount`` are kept on the job, the values of
+        every field are returned.
+        """
+        values = self.backend.get_data(self.id,
+                                       primary=self._read_from_primary,
+                                       fields=fields)
+        for field in fields:
+            if field in ("data", "amount"):
+                setattr(self, field, values[field])
+        return values
+
+    @property
+    def data(self):
+        """Return the job's metadata."""
+        if self._data is UNLOADED:
+            # Amount is small, batch it with the data.
+            self._hydrate("data", "amount")
+
+        data = self._data
+        if isinstance(data, LazyData):
+            data = self._data = data.load()
+        return data
+
+    @data.setter  # noqa
+    def data(self, data):
+        """Set the job's metadata, without storing it."""
+        self._data = data
+
+    @property
+    def amount(self):
+        """Return the amount of work to do."""
+        if self._amount is UNLOADED:
+            self._hydrate("amount")
+        return self._amount
+
+    @amount.setter  # noqa
+    def amount(self, amount):
+        """Set the amount of work to do, without storing it."""
+        self._amount = amount
 
     @property
     def is_ready(self):
@@ -85,34 +152,63 @@ class JobProgress(object):
     @property
     def state(self):
         """Return state."""
-        return self.backend.get_state(self.id)
+        unit_of_work = self.session.unit_of_work
+        if unit_of_work is not None:
+            state = unit_of_work.get_state(self.id)
+            if state is not None:
+                return state
+
+        return self.backend.get_state(self.id,
+                                      primary=self._read_from_primary)
 
     @state.setter  # noqa
     def state(self, state):
         """Set the state."""
-        self.backend.set_state(self.id, state, self._previous_state)
+        if self._previous_state is UNLOADED:
+            # The index can only be moved if we know where the job is.
+            self._previous_state = self.backend.get_state(self.id,
+                                                          primary=True)
+
+        unit_of_work = self.session.unit_of_work
+        if unit_of_work is not None:
+            unit_of_work.transition(self.id, self._previous_state, state)
+        else:
+            self.backend.set_state(self.id, state, self._previous_state)
+        self.session.pin(self.id)
         self._previous_state = state
 
     @property
     def is_staled(self):
         """Return True if staled."""
-        return self.state == states.STARTED and self.backend.is_staled(self.id)
+        return (self.state == states.STARTED and
+                self.backend.is_staled(self.id,
+                                       primary=self._read_from_primary))
 
-    def run(self, delete_on_closing=False):
+    def run(self, delete_on_closing=False, heartbeat_interval=None):
         """Return a context manager.
 
         :param bool delete: if ``True``, will delete on closing.
+        :param float heartbeat_interval: if set, the heartbeat is refreshed
+            every ``heartbeat_interval`` seconds by a background thread
+            shared by all jobs of the process, until closing.
+            ``heartbeat_enabled`` must be set on the backend.
         """
         self.delete_on_closing = delete_on_closing
+        self.heartbeat_interval = heartbeat_interval
         return self
 
     def __enter__(self):
         """Enter the context manager."""
         self.state = states.STARTED
+        if self.heartbeat_interval:
+            heartbeats.register(self.backend, self.id,
+                                self.heartbeat_interval)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         """Exit the context manager."""
+        if self.heartbeat_interval:
+            heartbeats.unregister(self.backend, self.id)
         if exc_value:
             self.state = states.FAILURE
         else:
@@ -122,6 +218,11 @@ class JobProgress(object):
 
     def add_one_progress_state(self, state):
         """Add one unit status."""
+        self.session.pin(self.id)
+
+        unit_of_work = self.session.unit_of_work
+        if unit_of_work is not None:
+            return unit_of_work.increment(self.id, state)
         return self.backend.add_one_progress_state(self.id, state)
 
     def add_one_failure(self):
@@ -132,6 +233,26 @@ class JobProgress(object):
         """Add one success state."""
         return self.add_one_progress_state(states.SUCCESS)
 
+    def track(self, iterable, batch_size=100, interval=1.0):
+        """Return an iterator over ``iterable`` tracking the job's progress.
+
+        See :class:`job_progress.tracking.ProgressTracker`.
+        """
+        return ProgressTracker(self, iterable, batch_size, interval)
+
+    def track_async(self, iterable, batch_size=100, interval=1.0):
+        """Like :meth:`track`, for asynchronous iterables (Python 3.6+)."""
+        # Not imported at the top since it is not valid Python 2.
+        from job_progress.aio import AsyncProgressTracker
+        return AsyncProgressTracker(self, iterable, batch_size, interval)
+
+    def reporter(self, interval=1.0):
+        """Return a reporter aggregating progress from child processes.
+
+        See :mod:`job_progress.reporter`.
+        """
+        return ProgressReporter(self, interval)
+
     def get_progress(self):
         """Return the progress.
 
@@ -145,18 +266,35 @@ class JobProgress(object):
             "pending": 32,
             }
         """
-        progress = self.backend.get_progress(self.id)
-        progress = {k: int(v) for k, v in progress.items()}
+        if self._amount is UNLOADED:
+            progress = self._hydrate("amount", "progress")["progress"]
+        else:
+            progress = self.backend.get_progress(
+                self.id, primary=self._read_from_primary)
+        return compute_progress(progress, self.amount)
+
+    def history(self):
+        """Return the state transitions of the job, oldest first.
+
+        Requires ``history_enabled``. Transitions collapsed by a unit of
+        work are not logged.
+
+        :rtype: list of ``(state, timestamp)`` tuples.
+        """
+        return self.backend.get_history(self.id,
+                                        primary=self._read_from_primary)
 
-        pending = 0
-        if self.amount:
-            # There can be a race condition before we have saved amount.
-            pending = int(self.amount) - sum(progress.values())
+    def durations(self):
+        """Return the time, in seconds, spent in each state.
 
-        if pending:
-            progress[states.PENDING] = pending
+        E.g.::
 
-        return progress
+            {
+            "PENDING": 12.5,
+            "STARTED": 63.1,
+            }
+        """
+        return compute_durations(self.history())
 
     def to_dict(self):
         """Return dict representation of the object."""
@@ -172,4 +310,13 @@ class JobProgress(object):
 
     def delete(self):
         """Delete the job."""
-        self.backend.delete_job(self.id, self.state)
+        unit_of_work = self.session.unit_of_work
+        if unit_of_work is not None:
+            state = self._previous_state
+            if state is UNLOADED:
+                state = self.backend.get_state(self.id, primary=True)
+            unit_of_work.delete(self.id, state)
+        else:
+            # Removed from every state index, no need to read the state.
+            self.backend.delete_jobs([self.id])
+        self.session.pin(self.id)
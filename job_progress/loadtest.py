@@ -0,0 +1,288 @@
+"""
+Load and contention test for a Redis backend.
+
+Many workers report progress on the same jobs, while pollers read them as
+a dashboard would. At the end, throughput and latency percentiles are
+reported, and the indexes are checked::
+
+    python -m job_progress.loadtest --url redis://localhost:6379/0 \\
+        --processes 4 --threads 50 --jobs 10 --units 10000
+
+The exit status is 1 if the jobs or the indexes are wrong afterwards.
+Jobs are created in their own namespace, and deleted at the end.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import multiprocessing
+import random
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from job_progress import JobProgress, Session, states
+from job_progress.backends.redis import JOB_LOG_PREFIX, RedisBackend
+
+
+def percentile(values, percent):
+    """Return the ``percent`` percentile of sorted ``values``."""
+    if not values:
+        return 0.0
+    index = int(round(percent / 100 * (len(values) - 1)))
+    return values[index]
+
+
+class LoadReport(object):
+
+    """Results of a load test.
+
+    :param int units: amount of progress units written.
+    :param float duration: duration of the writes, in seconds.
+    :param list write_latencies: latency of each write, in seconds.
+    :param list poll_latencies: latency of each poll, in seconds.
+    :param int errors: amount of failed writes.
+    :param list problems: descriptions of what was wrong afterwards.
+    """
+
+    def __init__(self, units, duration, write_latencies, poll_latencies,
+                 errors, problems):
+        self.units = units
+        self.duration = duration
+        self.write_latencies = sorted(write_latencies)
+        self.poll_latencies = sorted(poll_latencies)
+        self.errors = errors
+        self.problems = problems
+
+    @property
+    def is_correct(self):
+        """Return True if nothing was wrong afterwards."""
+        return not self.errors and not self.problems
+
+    @property
+    def throughput(self):
+        """Return the amount of units written per second."""
+        return self.units / self.duration if self.duration else 0.0
+
+    def format(self):
+        """Return a human readable report."""
+        lines = [
+            "units:      %d in %.2fs, %.0f/s" % (self.units, self.duration,
+                                                 self.throughput),
+            "errors:     %d" % self.errors,
+        ]
+        for name, latencies in (("writes", self.write_latencies),
+                                ("polls", self.poll_latencies)):
+            lines.append(
+                "%-11s p50 %.2fms, p95 %.2fms, p99 %.2fms, max %.2fms "
+                "(%d)" % (name + ":", percentile(latencies, 50) * 1000,
+                          percentile(latencies, 95) * 1000,
+                          percentile(latencies, 99) * 1000,
+                          percentile(latencies, 100) * 1000,
+                          len(latencies)))
+        lines.append("indexes:    %s" % ("ok" if not self.problems
+                                         else "WRONG"))
+        lines.extend("  - %s" % problem for problem in self.problems)
+        return "\n".join(lines)
+
+
+def _work(settings, ids, worker, workers, units, unit_duration,
+          failure_rate, results):
+    """Write the units of every job falling to ``worker``."""
+    session = Session(RedisBackend(settings))
+    latencies = []
+    errors = 0
+    started = set()
+
+    for unit in range(worker, len(ids) * units, workers):
+        id_ = ids[unit % len(ids)]
+        if unit_duration:
+            time.sleep(unit_duration)
+        state = (states.FAILURE if random.random() < failure_rate
+                 else states.SUCCESS)
+
+        begin = time.time()
+        try:
+            job = session.get(id_)
+            if id_ not in started:
+                job.state = states.STARTED
+                started.add(id_)
+            job.add_one_progress_state(state)
+        except Exception:
+            errors += 1
+        latencies.append(time.time() - begin)
+
+    results.put((latencies, errors))
+
+
+def _work_in_threads(settings, ids, process, processes, threads, units,
+                     unit_duration, failure_rate, results):
+    """Run ``threads`` workers, each reporting to ``results``."""
+    workers = [threading.Thread(target=_work,
+                                args=(settings, ids,
+                                      process * threads + thread,
+                                      processes * threads, units,
+                                      unit_duration, failure_rate, results))
+               for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def _poll(settings, ids, interval, done, latencies):
+    """Read the jobs as a dashboard would, until ``done`` is set."""
+    session = Session(RedisBackend(settings))
+    while not done.is_set():
+        begin = time.time()
+        session.backend.get_snapshots(ids, primary=True)
+        latencies.append(time.time() - begin)
+        done.wait(interval)
+
+
+def check(session, ids, units):
+    """Return descriptions of what is wrong with finished jobs."""
+    problems = []
+    rows = session.backend.get_snapshots(ids, primary=True, with_data=False)
+    for id_, state, _, _, progress in rows:
+        written = sum(int(count) for count in (progress or {}).values())
+        if written != units:
+            problems.append("%s: %d units instead of %d"
+                            % (id_, written, units))
+        if state != states.SUCCESS:
+            problems.append("%s: state is %s" % (id_, state))
+
+    expected = set(ids)
+    for state in states.ALL_STATES:
+        members = set(session.backend.get_ids(primary=True, state=state))
+        if state == states.SUCCESS and members != expected:
+            problems.append("%d jobs missing from the SUCCESS index"
+                            % len(expected - members))
+        elif state != states.SUCCESS and members:
+            problems.append("%d jobs left in the %s index"
+                            % (len(members), state))
+
+    if set(session.backend.get_ids(primary=True)) != expected:
+        problems.append("the index of all jobs is wrong")
+    return problems
+
+
+def run(settings, processes=1, threads=10, jobs=1, units=1000,
+        unit_duration=0, failure_rate=0, pollers=0, poll_interval=0.1):
+    """Run a load test and return a :class:`LoadReport`.
+
+    :param dict settings: :class:`RedisBackend` settings, with a dedicated
+        ``namespace``: the indexes are checked against the jobs of the run,
+        which are deleted at the end.
+    :param int processes: amount of worker processes, ``1`` runs workers
+        in the current process.
+    :param int threads: amount of worker threads per process.
+    :param int jobs: amount of jobs, each worker writes to all of them.
+    :param int units: amount of units per job.
+    :param float unit_duration: seconds of work before each unit.
+    :param float failure_rate: part of the units that fail.
+    :param int pollers: amount of threads reading the jobs meanwhile.
+    :param float poll_interval: seconds between reads of a poller.
+    """
+    backend = RedisBackend(settings)
+    if backend.settings["namespace"] == JOB_LOG_PREFIX:
+        raise ValueError("Load tests need a dedicated namespace, not '%s'"
+                         % JOB_LOG_PREFIX)
+    session = Session(backend)
+    ids = [JobProgress(amount=units, session=session).id
+           for _ in range(jobs)]
+
+    done = threading.Event()
+    poll_latencies = []
+    poll_threads = [threading.Thread(target=_poll,
+                                     args=(settings, ids, poll_interval, done,
+                                           poll_latencies))
+                    for _ in range(pollers)]
+    for thread in poll_threads:
+        thread.start()
+
+    begin = time.time()
+    if processes == 1:
+        results = queue.Queue()
+        _work_in_threads(settings, ids, 0, 1, threads, units,
+                         unit_duration, failure_rate, results)
+    else:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_work_in_threads,
+            args=(settings, ids, process, processes, threads, units,
+                  unit_duration, failure_rate, results))
+            for process in range(processes)]
+        for worker in workers:
+            worker.start()
+
+    write_latencies = []
+    errors = 0
+    for _ in range(processes * threads):
+        latencies, worker_errors = results.get()
+        write_latencies.extend(latencies)
+        errors += worker_errors
+    duration = time.time() - begin
+
+    if processes != 1:
+        for worker in workers:
+            worker.join()
+    done.set()
+    for thread in poll_threads:
+        thread.join()
+
+    # Jobs were cached in their initial state.
+    session.clear()
+    for id_ in ids:
+        session.get(id_).state = states.SUCCESS
+
+    try:
+        problems = check(session, ids, units)
+    finally:
+        session.backend.delete_jobs(ids)
+
+    return LoadReport(jobs * units, duration, write_latencies,
+                      poll_latencies, errors, problems)
+
+
+def main(argv=None):
+    """Run a load test from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Load and contention test for job_progress")
+    parser.add_argument("--url", default="redis://localhost:6379/0")
+    parser.add_argument("--namespace", default="jobprogress-loadtest")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--threads", type=int, default=10,
+                        help="worker threads per process")
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--units", type=int, default=1000,
+                        help="units per job")
+    parser.add_argument("--unit-duration", type=float, default=0,
+                        help="seconds of work per unit")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--pollers", type=int, default=0)
+    parser.add_argument("--poll-interval", type=float, default=0.1)
+    parser.add_argument("--heartbeat", action="store_true",
+                        help="enable heartbeats")
+    parser.add_argument("--history", action="store_true",
+                        help="enable the transition log")
+    args = parser.parse_args(argv)
+
+    settings = {
+        "backend_url": args.url,
+        "namespace": args.namespace,
+        "heartbeat_enabled": args.heartbeat,
+        "history_enabled": args.history,
+    }
+    report = run(settings, args.processes, args.threads, args.jobs,
+                 args.units, args.unit_duration, args.failure_rate,
+                 args.pollers, args.poll_interval)
+    print(report.format())
+    return 0 if report.is_correct else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,66 @@
+from __future__ import absolute_import
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicThread(object):
+
+    """
+    Call a function every ``interval`` seconds from a daemon thread.
+
+    Threads do not survive a fork: calling :meth:`start` in a child process
+    starts a new thread.
+
+    :param function function: function to call, without arguments.
+    :param float interval: interval in seconds, read before every wait so
+        that it can be changed while running.
+    :param str name: thread name.
+    """
+
+    def __init__(self, function, interval, name=None):
+        self.function = function
+        self.interval = interval
+        self.name = name
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+
+    @property
+    def is_running(self):
+        """Return True if the thread runs in the current process."""
+        return (self._thread is not None and self._pid == os.getpid() and
+                self._thread.is_alive() and not self._stopped.is_set())
+
+    def start(self):
+        """Start the thread, if it is not already running."""
+        if self.is_running:
+            return
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run,
+                                        args=(self._stopped,),
+                                        name=self.name)
+        self._thread.daemon = True
+        self._pid = os.getpid()
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stop the thread.
+
+        :param bool wait: if ``True``, wait for the current call to end.
+        """
+        self._stopped.set()
+        thread = self._thread
+        if (wait and thread is not None and self._pid == os.getpid() and
+                thread is not threading.current_thread()):
+            thread.join()
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            try:
+                self.function()
+            except Exception:
+                logger.exception("Error in %s", self.name or "thread")
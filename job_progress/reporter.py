@@ -0,0 +1,128 @@
+"""
+Progress reporting from worker processes.
+
+Child processes increment counters in shared memory, and the parent process
+writes the aggregated counts to the backend every ``interval`` seconds.
+Children thus need neither a backend connection nor a command per unit::
+
+    def toast(bread):
+        # Toast bread, then
+        reporter.get_reporter().add_one_success()
+
+    with job.reporter(interval=1) as progress_reporter:
+        pool = multiprocessing.Pool(initializer=progress_reporter.install)
+        pool.map(toast, breads)
+
+The reporter must reach children when they are created, e.g. through a pool
+``initializer``, since shared memory can only be inherited.
+"""
+from __future__ import absolute_import
+import multiprocessing
+
+from job_progress import states
+from job_progress.periodic import PeriodicThread
+from job_progress.unit_of_work import UnitOfWork
+
+_current = None
+
+
+def get_reporter():
+    """Return the reporter installed in the current process."""
+    if _current is None:
+        raise RuntimeError("No ProgressReporter was installed in this "
+                           "process")
+    return _current
+
+
+class ProgressReporter(object):
+
+    """
+    Aggregate progress counts from many processes.
+
+    :param JobProgress job: job the progress belongs to.
+    :param float interval: interval in seconds between writes.
+    """
+
+    def __init__(self, job, interval=1.0):
+        self.job_id = job.id
+        self.backend = job.backend
+        self.states = tuple(sorted(states.ALL_STATES))
+        self.counters = multiprocessing.Array("l", len(self.states))
+        #: unit of work whose flush failed, retried first
+        self._failed = None
+        self._flusher = PeriodicThread(self.flush, interval,
+                                       name="job_progress-reporter")
+
+    def __getstate__(self):
+        # Children only need the counters.
+        return {
+            "job_id": self.job_id,
+            "backend": None,
+            "states": self.states,
+            "counters": self.counters,
+            "_failed": None,
+            "_flusher": None,
+        }
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def install(self):
+        """Make this reporter the one :func:`get_reporter` returns.
+
+        Meant to be a pool ``initializer``.
+        """
+        global _current
+        _current = self
+
+    def add_one_progress_state(self, state, count=1):
+        """Add one unit status."""
+        index = self.states.index(state)
+        with self.counters.get_lock():
+            self.counters[index] += count
+
+    def add_one_failure(self):
+        """Add one failure state."""
+        self.add_one_progress_state(states.FAILURE)
+
+    def add_one_success(self):
+        """Add one success state."""
+        self.add_one_progress_state(states.SUCCESS)
+
+    def start(self):
+        """Start writing counts in the background."""
+        self._flusher.start()
+
+    def stop(self):
+        """Stop writing counts in the background, and write what's left."""
+        self._flusher.stop()
+        self.flush()
+
+    def flush(self):
+        """Write counts aggregated since the last call in one pipeline.
+
+        Counts that failed to be written are written again first, with the
+        same token, so that they are not counted twice.
+        """
+        if self._failed is not None:
+            self._failed.flush(self.backend)
+            self._failed = None
+
+        with self.counters.get_lock():
+            counts = self.counters[:]
+            self.counters[:] = [0] * len(counts)
+
+        unit_of_work = UnitOfWork(idempotent=True)
+        for state, count in zip(self.states, counts):
+            if count:
+                unit_of_work.increment(self.job_id, state, count)
+
+        try:
+            unit_of_work.flush(self.backend)
+        except Exception:
+            self._failed = unit_of_work
+            raise
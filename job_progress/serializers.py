@@ -0,0 +1,129 @@
+"""
+Serializers for job data.
+
+By default job data is stored as a Redis hash, which flattens every value
+to a string. When a ``data_serializer`` is configured, data is stored as a
+single value instead, and types and nested structures survive the round
+trip.
+
+Every payload starts with a one byte marker telling whether it was
+compressed, so ``compression_threshold`` can be changed at any time.
+"""
+from __future__ import absolute_import
+import json
+import zlib
+
+RAW = b"r"
+COMPRESSED = b"z"
+
+
+def _to_bytes(payload):
+    """Return ``payload`` as bytes."""
+    if isinstance(payload, bytes):
+        return payload
+    return payload.encode("utf-8")
+
+
+class JSONSerializer(object):
+
+    """Serialize data as JSON."""
+
+    def dumps(self, data):
+        """Return ``data`` serialized."""
+        return _to_bytes(json.dumps(data, separators=(",", ":")))
+
+    def loads(self, payload):
+        """Return deserialized ``payload``."""
+        return json.loads(payload.decode("utf-8"))
+
+
+class MsgpackSerializer(object):
+
+    """Serialize data with msgpack, which must be installed."""
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The 'msgpack' data_serializer requires the "
+                              "msgpack package")
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        """Return ``data`` serialized."""
+        return self.msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, payload):
+        """Return deserialized ``payload``."""
+        return self.msgpack.unpackb(payload, raw=False)
+
+
+class FramedSerializer(object):
+
+    """Wrap a serializer, compressing payloads above a size threshold.
+
+    :param serializer: wrapped serializer.
+    :param int threshold: payloads bigger than this amount of bytes are
+        compressed with zlib. ``None`` disables compression.
+    """
+
+    def __init__(self, serializer, threshold=None):
+        self.serializer = serializer
+        self.threshold = threshold
+
+    def dumps(self, data):
+        """Return ``data`` serialized."""
+        payload = self.serializer.dumps(data)
+        if self.threshold is not None and len(payload) > self.threshold:
+            return COMPRESSED + zlib.compress(payload)
+        return RAW + payload
+
+    def loads(self, payload):
+        """Return deserialized ``payload``."""
+        payload = _to_bytes(payload)
+        marker, payload = payload[:1], payload[1:]
+        if marker == COMPRESSED:
+            payload = zlib.decompress(payload)
+        elif marker != RAW:
+            raise ValueError("Unknown payload marker: '%r'" % marker)
+        return self.serializer.loads(payload)
+
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+def get_serializer(name, compression_threshold=None):
+    """Return the serializer called ``name``.
+
+    :param str name: serializer name, ``None`` for the legacy hash storage.
+    :param int compression_threshold: compress payloads above this size.
+    """
+    if name is None:
+        return None
+
+    try:
+        serializer_class = SERIALIZERS[name]
+    except KeyError:
+        raise ValueError("Unknown data_serializer: '%s'" % name)
+
+    return FramedSerializer(serializer_class(), compression_threshold)
+
+
+class LazyData(object):
+
+    """Serialized job data, deserialized when first needed."""
+
+    __slots__ = ("payload", "serializer")
+
+    def __init__(self, payload, serializer):
+        self.payload = payload
+        self.serializer = serializer
+
+    def load(self):
+        """Return deserialized data."""
+        if self.payload is None:
+            return {}
+        return self.serializer.loads(self.payload)
@@ -1,7 +1,11 @@
 from __future__ import absolute_import
+import contextlib
+import time
 import weakref
 
-from job_progress.job_progress import JobProgress
+from job_progress.job_progress import UNLOADED, JobProgress
+from job_progress.snapshot import JobSnapshot, SnapshotColumns
+from job_progress.unit_of_work import UnitOfWork
 
 
 class Session(object):
@@ -9,12 +13,28 @@ class Session(object):
     """
     The Session object mimics sqlalchemy's session, but does caching
     so that we don't reload an object.
+
+    :param backend: backend instance.
+    :param bool read_your_writes: if ``True``, reads of jobs written through
+        this session are sent to the primary rather than to a replica.
+    :param int read_your_writes_window: how long, in seconds, a written job
+        stays pinned to the primary.
+    :param str namespace: if set, jobs are stored in this namespace rather
+        than the backend's, e.g. one per tenant. Requires a backend
+        supporting namespaces.
     """
 
-    def __init__(self, backend):
+    def __init__(self, backend, read_your_writes=False,
+                 read_your_writes_window=10, namespace=None):
+        if namespace is not None:
+            backend = backend.for_namespace(namespace)
         self.objects = self._new_cache_storage()
         self.backend = backend
         self.job_progress_class = JobProgress
+        self.read_your_writes = read_your_writes
+        self.read_your_writes_window = read_your_writes_window
+        self._written_at = {}
+        self.unit_of_work = None
 
     def get(self, id_):
         """Get an object from the backend."""
@@ -23,10 +43,9 @@ class Session(object):
         if obj:
             return obj
 
-        # Get the data from the backend
-        data = self.backend.get_data(id_)
-        # Instantiate the object
-        obj = self.job_progress_class.from_backend(id_=id_, **data)
+        # Instantiate the object, its fields are loaded from the backend
+        # when first accessed.
+        obj = self.job_progress_class.from_backend(id_=id_, session=self)
         # Add it to the cache
         self.add(id_, obj)
 
@@ -40,6 +59,64 @@ class Session(object):
         """Clear the cache."""
         self.objects = self._new_cache_storage()
 
+    @contextlib.contextmanager
+    def begin(self):
+        """Return a context manager queuing writes until it exits.
+
+        State transitions, progress increments and deletions are then
+        coalesced and written in one pipeline, on exit or when
+        :meth:`flush` is called. If the block raises, the queued writes are
+        discarded. Creating a job is not deferred.
+        """
+        if self.unit_of_work is not None:
+            raise RuntimeError("A unit of work is already in progress")
+
+        self.unit_of_work = UnitOfWork()
+        try:
+            yield self
+            self.flush()
+        except Exception:
+            self._expire(self.unit_of_work)
+            raise
+        finally:
+            self.unit_of_work = None
+
+    def flush(self):
+        """Write the writes queued since :meth:`begin`."""
+        if self.unit_of_work is not None:
+            self.unit_of_work.flush(self.backend)
+
+    def _expire(self, unit_of_work):
+        """Forget the state of jobs with discarded transitions."""
+        for id_ in unit_of_work.transitions:
+            obj = self.objects.get(id_)
+            if obj is not None:
+                obj._previous_state = UNLOADED
+
+    def pin(self, id_):
+        """Record a write, so that the job is read from the primary."""
+        if self.read_your_writes:
+            self._written_at[id_] = time.time()
+
+    def is_pinned(self, id_):
+        """Return True if the job must be read from the primary."""
+        written_at = self._written_at.get(id_)
+        if written_at is None:
+            return False
+
+        if time.time() - written_at > self.read_your_writes_window:
+            self._written_at.pop(id_, None)
+            return False
+        return True
+
+    def has_pins(self):
+        """Return True if any job must be read from the primary."""
+        expired_before = time.time() - self.read_your_writes_window
+        for id_, written_at in list(self._written_at.items()):
+            if written_at < expired_before:
+                self._written_at.pop(id_, None)
+        return bool(self._written_at)
+
     def _new_cache_storage(self):
         return weakref.WeakValueDictionary()
 
@@ -56,5 +133,62 @@ class Session(object):
         This method should be considered alpha.
         """
 
-        ids = self.backend.get_ids(**filters)
+        ids = self.backend.get_ids(primary=self.has_pins(), **filters)
         return [self.get(id_) for id_ in ids]
+
+    def delete_where(self, batch_size=1000, **filters):
+        """Delete the jobs matching ``filters``, without loading them.
+
+        See :meth:`query` for the supported filters.
+
+        :rtype: int, the amount of deleted jobs.
+        """
+        return self.backend.delete_where(batch_size=batch_size,
+                                         on_deleted=self._evict, **filters)
+
+    def _evict(self, ids):
+        """Remove jobs from the cache."""
+        for id_ in ids:
+            self.objects.pop(id_, None)
+
+    def count(self, **filters):
+        """Return the amount of jobs matching ``filters``.
+
+        See :meth:`query` for the supported filters.
+        """
+        return self.backend.count(primary=self.has_pins(), **filters)
+
+    def snapshot(self, id_):
+        """Return a :class:`JobSnapshot` of a job, read in one round trip."""
+        row, = self.backend.get_snapshots([id_], primary=self.is_pinned(id_))
+        return JobSnapshot(*row)
+
+    def iter_snapshot_rows(self, batch_size=1000, with_data=True, **filters):
+        """Yield raw snapshot rows of the jobs matching ``filters``.
+
+        Jobs are read by batches of ``batch_size``, one pipeline per batch.
+        """
+        primary = self.has_pins()
+        ids = self.backend.get_ids(primary=primary, **filters)
+        for start in range(0, len(ids), batch_size):
+            rows = self.backend.get_snapshots(ids[start:start + batch_size],
+                                              primary=primary,
+                                              with_data=with_data)
+            for row in rows:
+                yield row
+
+    def iter_snapshots(self, batch_size=1000, with_data=True, **filters):
+        """Yield a :class:`JobSnapshot` for each job matching ``filters``.
+
+        See :meth:`query` for the supported filters.
+        """
+        for row in self.iter_snapshot_rows(batch_size, with_data, **filters):
+            yield JobSnapshot(*row)
+
+    def snapshot_columns(self, batch_size=1000, with_data=True, **filters):
+        """Return :class:`SnapshotColumns` for the jobs matching ``filters``.
+
+        See :meth:`query` for the supported filters.
+        """
+        return SnapshotColumns.from_rows(
+            self.iter_snapshot_rows(batch_size, with_data, **filters))
@@ -0,0 +1,120 @@
+"""
+Lightweight, read-only views of jobs for bulk reads.
+
+Unlike :class:`job_progress.JobProgress`, snapshots are materialized from a
+single pipelined read and never go back to the backend.
+"""
+from __future__ import absolute_import
+from array import array
+
+from job_progress import states
+from job_progress.serializers import LazyData
+from job_progress.utils import compute_progress
+
+
+def _to_int(amount):
+    """Return ``amount`` as an int, ``0`` if unknown."""
+    return int(amount) if amount else 0
+
+
+class JobSnapshot(object):
+
+    """Read-only view of a job at a point in time.
+
+    :param str id_: job identifier.
+    :param str state: job state.
+    :param amount: amount of work to do.
+    :param data: job metadata, ``None`` if it was not read.
+    :param dict progress: progress counts as stored in the backend.
+    """
+
+    __slots__ = ("id", "state", "amount", "progress", "_data")
+
+    def __init__(self, id_, state, amount, data, progress):
+        set_ = object.__setattr__
+        set_(self, "id", id_)
+        set_(self, "state", state)
+        set_(self, "amount", _to_int(amount))
+        set_(self, "progress", compute_progress(progress, amount))
+        set_(self, "_data", data)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("%s is read-only" % self.__class__.__name__)
+
+    def __repr__(self):
+        """Return repr of the object."""
+        return "<%s '%s'>" % (self.__class__.__name__, self.id)
+
+    @property
+    def data(self):
+        """Return the job's metadata."""
+        data = self._data
+        if isinstance(data, LazyData):
+            data = data.load()
+            object.__setattr__(self, "_data", data)
+        return data
+
+    @property
+    def is_ready(self):
+        """Return True if is ready."""
+        return self.state in states.READY_STATES
+
+    def to_dict(self):
+        """Return dict representation of the object."""
+        return {
+            "id": self.id,
+            "data": self.data,
+            "amount": self.amount,
+            "progress": dict(self.progress),
+            "is_ready": self.is_ready,
+            "state": self.state,
+        }
+
+
+class SnapshotColumns(object):
+
+    """Column oriented snapshots of many jobs, for bulk exports.
+
+    Amounts and progress counts are stored in arrays of integers, one per
+    state, so that a row costs a few machine words instead of an object.
+    Row ``i`` of every column describes the same job.
+    """
+
+    __slots__ = ("ids", "states", "amounts", "progress", "data")
+
+    def __init__(self, ids, states_, amounts, progress, data):
+        self.ids = ids
+        self.states = states_
+        self.amounts = amounts
+        self.progress = progress
+        self.data = data
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build columns from rows as returned by ``get_snapshots``."""
+        ids, job_states, data = [], [], []
+        amounts = array("l")
+        progress = dict((state, array("l")) for state in states.ALL_STATES)
+
+        for id_, state, amount, job_data, job_progress in rows:
+            job_progress = compute_progress(job_progress, amount)
+            ids.append(id_)
+            job_states.append(state)
+            amounts.append(_to_int(amount))
+            for state_name, counts in progress.items():
+                counts.append(job_progress.get(state_name, 0))
+            data.append(job_data)
+
+        return cls(tuple(ids), tuple(job_states), amounts, progress,
+                   tuple(data))
+
+    def snapshot(self, index):
+        """Return the :class:`JobSnapshot` at ``index``."""
+        progress = dict((state, counts[index])
+                        for state, counts in self.progress.items()
+                        if counts[index] and state != states.PENDING)
+        return JobSnapshot(self.ids[index], self.states[index],
+                           self.amounts[index], self.data[index], progress)
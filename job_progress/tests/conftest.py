@@ -0,0 +1,11 @@
+import pytest
+import redis
+
+from job_progress.tests.fixtures.jobprogress import TEST_CONFIG
+
+
+@pytest.fixture
+def flushdb(request):
+    """Flush the Redis database of the tests after the test."""
+    client = redis.StrictRedis.from_url(TEST_CONFIG["backend_url"])
+    request.addfinalizer(client.flushdb)
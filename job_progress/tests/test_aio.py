@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from job_progress import states
+from job_progress.tests.fixtures.jobprogress import JobProgress, session
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+async def _breads(amount):
+    for bread in range(amount):
+        await asyncio.sleep(0)
+        yield bread
+
+
+def test_track_async():
+    """Verify that asynchronous iteration tracks the progress."""
+    job = JobProgress(amount=3)
+
+    async def toast():
+        tracker = job.track_async(_breads(3), batch_size=2)
+        async for bread in tracker:
+            if bread == 0:
+                tracker.mark_failure()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(toast())
+    finally:
+        loop.close()
+
+    assert job.state == states.SUCCESS
+    assert session.get(job.id).get_progress() == {"SUCCESS": 2,
+                                                  "FAILURE": 1}
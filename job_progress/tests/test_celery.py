@@ -0,0 +1,71 @@
+import mock
+import pytest
+
+from job_progress import states
+from job_progress.celery import CeleryIntegration
+from job_progress.tests.fixtures.jobprogress import JobProgress, session
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+def _task(task_id):
+    return mock.Mock(request=mock.Mock(id=task_id))
+
+
+def test_task_signals():
+    """Verify that task signals are written by batches."""
+    job = JobProgress(amount=3)
+    integration = CeleryIntegration(session, interval=60)
+
+    for task_id in ("a", "b", "c"):
+        integration.on_task_prerun(task_id=task_id, args=(),
+                                   kwargs={"job_progress_id": job.id})
+    integration.on_task_success(sender=_task("a"), result=None)
+    integration.on_task_failure(task_id="b", exception=ValueError())
+    integration.on_task_revoked(request=mock.Mock(id="c"))
+    integration.on_task_prerun(task_id="d", args=(), kwargs={})
+    integration.on_task_success(sender=_task("d"), result=None)
+
+    assert job.state == states.PENDING
+    assert job.get_progress() == {states.PENDING: 3}
+
+    integration.on_worker_shutdown()
+
+    assert job.state == states.STARTED
+    assert job.get_progress() == {states.SUCCESS: 1, states.FAILURE: 1,
+                                  states.REVOKED: 1}
+    assert session.query(state=states.STARTED) == [job]
+
+
+def test_flush_error():
+    """Verify that events are kept when writing fails."""
+    job = JobProgress(amount=1)
+    integration = CeleryIntegration(session, interval=60)
+    integration.on_task_prerun(task_id="a", args=(),
+                               kwargs={"job_progress_id": job.id})
+    integration.on_task_success(sender=_task("a"), result=None)
+
+    with mock.patch.object(session.backend, "flush_changes",
+                           side_effect=IOError):
+        try:
+            integration.flush()
+        except IOError:
+            pass
+
+    integration.flush()
+    assert job.state == states.STARTED
+    assert job.get_progress() == {states.SUCCESS: 1}
+
+
+def test_finished_job_is_not_started():
+    """Verify that a job finished before the flush stays finished."""
+    job = JobProgress(amount=1)
+    integration = CeleryIntegration(session, interval=60)
+    integration.on_task_prerun(task_id="a", args=(),
+                               kwargs={"job_progress_id": job.id})
+    job.state = states.SUCCESS
+
+    integration.flush()
+    assert session.backend.get_state(job.id) == states.SUCCESS
+    assert session.query(state=states.SUCCESS) == [job]
+    assert session.count(state=states.STARTED) == 0
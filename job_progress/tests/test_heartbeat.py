@@ -0,0 +1,64 @@
+import threading
+import time
+
+import mock
+
+from job_progress.heartbeat import Heartbeats
+
+
+def test_beat():
+    """Verify that heartbeats are refreshed per backend in one call."""
+    heartbeats = Heartbeats()
+    backend, other_backend = mock.Mock(), mock.Mock()
+
+    heartbeats.register(backend, "a", 10)
+    heartbeats.register(backend, "b", 5)
+    heartbeats.register(other_backend, "c", 10)
+    assert heartbeats._thread.interval == 5
+    assert heartbeats._thread.is_running is True
+
+    heartbeats.beat()
+    assert sorted(backend.update_heartbeats.call_args[0][0]) == ["a", "b"]
+    other_backend.update_heartbeats.assert_called_once_with(["c"])
+
+    heartbeats.unregister(backend, "b")
+    assert heartbeats._thread.interval == 10
+
+    heartbeats.unregister(backend, "a")
+    heartbeats.unregister(other_backend, "c")
+    assert heartbeats._thread.is_running is False
+
+
+def test_forget_jobs_after_fork():
+    """Verify that a child does not refresh its parent's jobs."""
+    heartbeats = Heartbeats()
+    backend = mock.Mock()
+    heartbeats.register(backend, "a", 10)
+
+    with mock.patch("os.getpid", return_value=-1):
+        heartbeats.beat()
+
+    assert backend.update_heartbeats.called is False
+    heartbeats._thread.stop()
+
+
+def test_unregister_waits_for_beat():
+    """Verify that no heartbeat is written after unregistering."""
+    heartbeats = Heartbeats()
+    writing, written = threading.Event(), []
+    backend = mock.Mock()
+
+    def update_heartbeats(ids):
+        writing.set()
+        time.sleep(0.1)
+        written.append(ids)
+
+    backend.update_heartbeats.side_effect = update_heartbeats
+    heartbeats.register(backend, "a", 60)
+    beat = threading.Thread(target=heartbeats.beat)
+    beat.start()
+    writing.wait()
+
+    heartbeats.unregister(backend, "a")
+    assert written == [["a"]]
+    beat.join()
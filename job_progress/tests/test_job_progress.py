@@ -1,24 +1,18 @@
 from __future__ import absolute_import
+import multiprocessing
+import time
 
 import mock
 import pytest
 import redis
 
-from job_progress import utils
-from job_progress import states
+from job_progress import Session, utils
+from job_progress import reporter, states
+from job_progress.backends.redis import RedisBackend
 from job_progress.tests.fixtures.jobprogress import JobProgress, session
 from job_progress.tests.fixtures.jobprogress import TEST_CONFIG
 
-
-def teardown_function(function):
-    # Flush the db.
-    _flush_db(TEST_CONFIG["backend_url"])
-
-
-def _flush_db(url):
-    """Flush a Redis database."""
-    client = redis.StrictRedis.from_url(url)
-    client.flushdb()
+pytestmark = pytest.mark.usefixtures("flushdb")
 
 
 def test_flow():
@@ -182,3 +176,378 @@ def test_delete():
     job.delete()
 
     assert len(redis_client.keys("*")) == 0
+
+
+def test_serialized_data():
+    """Verify that serialized data keeps its types."""
+    settings = dict(TEST_CONFIG)
+    settings["data_serializer"] = "json"
+    json_session = Session(RedisBackend(settings))
+    data = {"toasts": 2, "options": {"butter": True}}
+    job = JobProgress(data, amount=2, session=json_session)
+
+    json_session.clear()
+    loaded = json_session.get(job.id)
+
+    assert loaded is not job
+    assert loaded.data == data
+
+
+def test_hash_data_strings():
+    """Verify that booleans and None are stored as strings in hashes."""
+    job = JobProgress({"flag": True, "nothing": None}, amount=1)
+
+    session.clear()
+    loaded = session.get(job.id)
+
+    assert loaded.data == {"flag": "True", "nothing": "None"}
+
+
+def test_lazy_hydration():
+    """Verify that data and amount are only loaded when accessed."""
+    job = JobProgress({"toaster": "bidule"}, amount=3)
+    job.add_one_success()
+    job_id = job.id
+    del job
+    session.clear()
+
+    backend = session.backend
+    with mock.patch.object(backend, "get_data",
+                           wraps=backend.get_data) as get_data:
+        job = session.get(job_id)
+        assert get_data.called is False
+
+        assert job.get_progress() == {"SUCCESS": 1, "PENDING": 2}
+        get_data.assert_called_once_with(job_id, primary=False,
+                                         fields=("amount", "progress"))
+        assert "progress" not in vars(job)
+
+        assert job.data == {"toaster": "bidule"}
+        assert job.amount == "3"
+        assert get_data.call_count == 2
+
+
+def test_snapshots():
+    """Verify that snapshots are read in bulk."""
+    job = JobProgress({"toaster": "bidule"}, amount=3)
+    job.add_one_success()
+    job.state = states.STARTED
+    other = JobProgress(amount=1)
+
+    snapshot = session.snapshot(job.id)
+    assert snapshot.to_dict() == job.to_dict()
+    with pytest.raises(AttributeError):
+        snapshot.state = states.SUCCESS
+
+    snapshots = list(session.iter_snapshots(batch_size=1, state="STARTED"))
+    assert [s.id for s in snapshots] == [job.id]
+
+    columns = session.snapshot_columns(with_data=False)
+    assert len(columns) == 2
+    assert sorted(columns.ids) == sorted([job.id, other.id])
+    index = columns.ids.index(job.id)
+    assert columns.states[index] == states.STARTED
+    assert columns.amounts[index] == 3
+    assert columns.progress[states.SUCCESS][index] == 1
+    assert columns.progress[states.PENDING][index] == 2
+    assert columns.snapshot(index).progress == job.get_progress()
+
+
+def test_unit_of_work():
+    """Verify that writes are deferred and flushed in one pipeline."""
+    job = JobProgress(amount=3)
+    other = JobProgress(amount=1)
+    deleted = JobProgress(amount=1)
+    backend = session.backend
+
+    with mock.patch.object(backend, "flush_changes",
+                           wraps=backend.flush_changes) as flush_changes:
+        with session.begin():
+            job.state = states.STARTED
+            job.add_one_success()
+            job.add_one_success()
+            job.add_one_failure()
+            job.state = states.SUCCESS
+            other.state = states.SCHEDULED
+            deleted.add_one_success()
+            deleted.delete()
+
+            assert job.state == states.SUCCESS
+            assert backend.get_state(job.id) == states.PENDING
+            assert backend.get_progress(job.id) == {}
+
+        assert flush_changes.call_count == 1
+
+    assert backend.get_state(job.id) == states.SUCCESS
+    assert job.get_progress() == {"SUCCESS": 2, "FAILURE": 1}
+    assert JobProgress.query(state=states.SUCCESS) == [job]
+    assert JobProgress.query(state=states.SCHEDULED) == [other]
+    assert JobProgress.query(state=states.STARTED) == []
+    assert sorted(j.id for j in JobProgress.query()) == sorted(
+        [job.id, other.id])
+
+
+def test_unit_of_work_rollback():
+    """Verify that queued writes are discarded on error."""
+    job = JobProgress(amount=1)
+
+    with pytest.raises(ValueError):
+        with session.begin():
+            job.state = states.STARTED
+            raise ValueError()
+
+    assert job.state == states.PENDING
+    job.state = states.SUCCESS
+    assert JobProgress.query(state=states.PENDING) == []
+    assert JobProgress.query(state=states.SUCCESS) == [job]
+
+
+def test_background_heartbeat():
+    """Verify that running jobs get their heartbeat refreshed."""
+    job = JobProgress(amount=1)
+    heartbeat_key = job.backend._get_metadata_key(
+        job.backend._get_key_for_job_id(job.id), "heartbeat")
+
+    with job.run(heartbeat_interval=0.01):
+        job.backend.client.delete(heartbeat_key)
+        assert job.is_staled is True
+        time.sleep(0.1)
+        assert job.is_staled is False
+
+    job.backend.client.delete(heartbeat_key)
+    time.sleep(0.05)
+    assert job.backend.is_staled(job.id) is True
+
+
+def test_history():
+    """Verify that transitions are logged."""
+    settings = dict(TEST_CONFIG)
+    settings["history_enabled"] = True
+    settings["history_max_length"] = 3
+    history_session = Session(RedisBackend(settings))
+    job = JobProgress(amount=1, session=history_session)
+
+    job.state = states.SCHEDULED
+    job.state = states.STARTED
+    assert [state for state, _ in job.history()] == [
+        states.PENDING, states.SCHEDULED, states.STARTED]
+
+    job.state = states.SUCCESS
+    history = job.history()
+    assert [state for state, _ in history] == [
+        states.SCHEDULED, states.STARTED, states.SUCCESS]
+    assert sorted(job.durations()) == [states.SCHEDULED, states.STARTED]
+
+    job.delete()
+    assert job.history() == []
+
+
+@pytest.mark.parametrize("using_twemproxy", [False, True])
+def test_reconcile_indexes(using_twemproxy):
+    """Verify that dangling and misplaced ids are repaired."""
+    backend = session.backend
+    with mock.patch.dict(backend.settings, using_twemproxy=using_twemproxy):
+        _test_reconcile_indexes(backend)
+
+
+def _test_reconcile_indexes(backend):
+    client = backend.client
+    expired = JobProgress(amount=1)
+    misplaced = JobProgress(amount=1)
+    missing = JobProgress(amount=1)
+    job = JobProgress(amount=1)
+
+    for name in ("state", "amount"):
+        client.delete(backend._get_metadata_key(
+            backend._get_key_for_job_id(expired.id), name))
+    client.set(backend._get_metadata_key(
+        backend._get_key_for_job_id(misplaced.id), "state"), states.SUCCESS)
+    client.srem(backend._get_key_for_index("state", states.PENDING),
+                backend._get_key_for_job_id(missing.id))
+    client.set(backend._get_metadata_key(
+        backend._get_key_for_job_id(missing.id), "state"), states.STARTED)
+
+    report = utils.reconcile_indexes(session, batch_size=2,
+                                     max_batches_per_second=1000)
+
+    assert report["dangling"] == 1
+    assert report["misplaced"] == 1
+    assert report["missing"] == 1
+    assert JobProgress.query(state=states.PENDING) == [job]
+    assert JobProgress.query(state=states.SUCCESS) == [misplaced]
+    assert JobProgress.query(state=states.STARTED) == [missing]
+    assert expired.id not in [j.id for j in JobProgress.query()]
+
+    report = utils.reconcile_indexes(session)
+    assert report == {"scanned": 6, "dangling": 0, "misplaced": 0,
+                      "missing": 0}
+
+
+def test_prune_expired_jobs():
+    """Verify that expired jobs are removed from the indexes."""
+    settings = dict(TEST_CONFIG)
+    settings["expiration"] = 60
+    expiring_session = Session(RedisBackend(settings))
+    backend = expiring_session.backend
+    expired = JobProgress(amount=1, session=expiring_session)
+    expired.state = states.STARTED
+    job = JobProgress(amount=1, session=expiring_session)
+
+    # The state index itself does not expire.
+    index_key = backend._get_key_for_index("state", states.STARTED)
+    assert backend.client.ttl(index_key) == -1
+
+    backend.client.execute_command(
+        "ZADD", backend._get_key_for_index("expiry"), 0,
+        backend._get_key_for_job_id(expired.id))
+
+    assert utils.prune_expired_jobs(expiring_session, batch_size=1) == 1
+    assert expiring_session.query() == [job]
+    assert expiring_session.query(state=states.STARTED) == []
+    assert backend.get_state(expired.id) is None
+
+    job.delete()
+    assert backend.client.keys("*") == []
+
+
+def _toast(bread):
+    if bread % 3:
+        reporter.get_reporter().add_one_success()
+    else:
+        reporter.get_reporter().add_one_failure()
+
+
+def test_reporter():
+    """Verify that child processes report progress through the parent."""
+    job = JobProgress(amount=12)
+
+    with job.reporter(interval=60) as progress_reporter:
+        pool = multiprocessing.Pool(2, initializer=progress_reporter.install)
+        try:
+            pool.map(_toast, range(10))
+        finally:
+            pool.close()
+            pool.join()
+
+        assert job.get_progress() == {"PENDING": 12}
+
+    assert job.get_progress() == {"SUCCESS": 6, "FAILURE": 4, "PENDING": 2}
+
+
+def test_track():
+    """Verify that iterating tracks the progress."""
+    job = JobProgress(amount=1)
+    backend = session.backend
+
+    tracker = job.track(range(5), batch_size=2, interval=60)
+    with mock.patch.object(backend, "flush_changes",
+                           wraps=backend.flush_changes) as flush_changes:
+        for item in tracker:
+            assert job.state == states.STARTED
+            if item == 3:
+                tracker.mark_failure()
+        assert flush_changes.call_count == 3
+
+    assert job.state == states.SUCCESS
+    assert job.amount == 5
+    assert job.get_progress() == {"SUCCESS": 4, "FAILURE": 1}
+
+
+def test_track_loaded_job():
+    """Verify that the amount of a loaded job is not written again."""
+    job_id = JobProgress(amount=3).id
+    session.clear()
+    job = session.get(job_id)
+
+    with mock.patch.object(session.backend, "set_amount") as set_amount:
+        assert list(job.track([1, 2, 3])) == [1, 2, 3]
+    assert set_amount.called is False
+    assert job.get_progress() == {"SUCCESS": 3}
+
+
+def test_track_interrupted():
+    """Verify that the job fails if iteration is interrupted."""
+    job = JobProgress(amount=3)
+
+    with pytest.raises(ValueError):
+        for item in job.track(iter([1, 2, 3])):
+            if item == 2:
+                raise ValueError()
+
+    assert job.state == states.FAILURE
+    assert job.amount == 3
+    assert job.get_progress() == {"SUCCESS": 1, "FAILURE": 1, "PENDING": 1}
+
+
+def test_namespaces():
+    """Verify that namespaces partition jobs."""
+    toaster_session = Session(session.backend, namespace="toaster")
+    job = JobProgress(amount=1)
+    toaster_job = JobProgress(amount=1, session=toaster_session)
+    toaster_job.state = states.SUCCESS
+
+    assert JobProgress.query() == [job]
+    assert toaster_session.query() == [toaster_job]
+    assert toaster_session.count() == 1
+    assert toaster_session.count(is_ready=True) == 1
+    assert toaster_session.count(state=states.PENDING) == 0
+    assert session.count(is_ready=False) == 1
+    assert toaster_session.backend.client is session.backend.client
+
+    assert toaster_session.backend.purge() == 1
+    assert toaster_session.count() == 0
+    assert toaster_session.backend.client.keys("toaster:*") == []
+    assert JobProgress.query() == [job]
+
+
+def test_delete_where():
+    """Verify that jobs are deleted by batches without being loaded."""
+    jobs = [JobProgress(amount=1) for _ in range(5)]
+    for job in jobs[:3]:
+        job.state = states.SUCCESS
+
+    with mock.patch.object(session.backend, "get_data") as get_data:
+        assert session.delete_where(batch_size=2, is_ready=True) == 3
+        assert get_data.called is False
+
+    assert sorted(j.id for j in JobProgress.query()) == sorted(
+        job.id for job in jobs[3:])
+    assert session.count(is_ready=True) == 0
+
+    assert session.backend.delete_jobs([job.id for job in jobs[3:]]) == 2
+    assert session.backend.client.keys("*") == []
+
+
+def test_add_progress():
+    """Verify that progress counts are added once per token."""
+    job = JobProgress(amount=5)
+    counts = {states.SUCCESS: 2, states.FAILURE: 1}
+
+    assert session.backend.add_progress(job.id, counts, "token") is True
+    assert session.backend.add_progress(job.id, counts, "token") is False
+    assert job.get_progress() == {"SUCCESS": 2, "FAILURE": 1, "PENDING": 2}
+
+    backend = RedisBackend(dict(TEST_CONFIG, increment_tokens_max=1))
+    assert backend.add_progress(job.id, {states.SUCCESS: 1}, "other")
+    assert backend.add_progress(job.id, {states.SUCCESS: 1}, "token")
+    assert job.get_progress() == {"SUCCESS": 4, "FAILURE": 1}
+
+
+def test_transition_jobs():
+    """Verify that jobs are started with their heartbeat, atomically."""
+    backend = RedisBackend(dict(TEST_CONFIG, heartbeat_enabled=True))
+    pending, finished = JobProgress(amount=1), JobProgress(amount=1)
+    finished.state = states.SUCCESS
+
+    # The heartbeat is written by the script, before anything else.
+    with mock.patch.object(backend, "_write_history", side_effect=IOError):
+        with pytest.raises(IOError):
+            backend.transition_jobs([pending.id, finished.id],
+                                    states.STARTED, states.REVOKABLE_STATES)
+
+    assert backend.get_state(pending.id) == states.STARTED
+    assert backend.get_state(finished.id) == states.SUCCESS
+    started_age, finished_age = backend.get_heartbeat_ages(
+        [pending.id, finished.id])
+    assert started_age is not None and finished_age is None
+    assert backend.get_ids(state=states.STARTED) == [pending.id]
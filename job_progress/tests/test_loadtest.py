@@ -0,0 +1,32 @@
+import pytest
+
+from job_progress import loadtest
+from job_progress.tests.fixtures.jobprogress import TEST_CONFIG
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+def test_run():
+    """Verify that a small load test is correct."""
+    settings = dict(TEST_CONFIG, namespace="loadtest")
+    report = loadtest.run(settings, threads=4, jobs=3, units=20,
+                          failure_rate=0.5, pollers=1, poll_interval=0)
+
+    assert report.is_correct, report.format()
+    assert report.units == 60
+    assert len(report.write_latencies) == 60
+    assert report.poll_latencies
+
+
+def test_percentile():
+    """Verify nearest rank percentiles."""
+    values = list(range(101))
+    assert loadtest.percentile(values, 50) == 50
+    assert loadtest.percentile(values, 99) == 99
+    assert loadtest.percentile([], 50) == 0.0
+
+
+def test_run_default_namespace():
+    """Verify that load tests do not run in the default namespace."""
+    with pytest.raises(ValueError):
+        loadtest.run(dict(TEST_CONFIG), threads=1, units=1)
@@ -1,4 +1,7 @@
+import os
+
 import mock
+import redis
 
 from job_progress import states
 from job_progress.backends.redis import RedisBackend
@@ -33,3 +36,138 @@ def test_initialize_without_twemproxy():
     redis_backend.initialize_job('my_id', {'my': 'data'}, states.PENDING, 42)
 
     assert fake_pipeline.execute.called is False
+
+
+def test_backends_share_connection_pool():
+    """Verify that backends with the same settings share a pool."""
+    first = RedisBackend(TEST_CONFIG)
+    second = RedisBackend(TEST_CONFIG)
+
+    assert (first.client.connection_pool is
+            second.client.connection_pool)
+
+
+def test_blocking_connection_pool():
+    """Verify that pool settings are used."""
+    settings = dict(TEST_CONFIG)
+    settings['blocking_pool'] = True
+    settings['max_connections'] = 7
+    redis_backend = RedisBackend(settings)
+
+    pool = redis_backend.client.connection_pool
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert pool.max_connections == 7
+
+
+def test_client_is_recreated_after_fork():
+    """Verify that a forked process does not reuse the parent's client."""
+    redis_backend = RedisBackend(TEST_CONFIG)
+    client = redis_backend.client
+    pool = client.connection_pool
+
+    with mock.patch('os.getpid', return_value=-1):
+        assert redis_backend.client is not client
+        assert redis_backend.client.connection_pool is not pool
+
+
+def test_read_replicas_round_robin():
+    """Verify that reads are spread over replicas."""
+    settings = dict(TEST_CONFIG)
+    settings['replica_urls'] = ['redis://localhost:6380/0',
+                                'redis://localhost:6381/0']
+    redis_backend = RedisBackend(settings)
+    first, second = redis_backend.replicas
+
+    assert redis_backend.get_read_client() is first
+    assert redis_backend.get_read_client() is second
+    assert redis_backend.get_read_client() is first
+    assert redis_backend.get_read_client(primary=True) is redis_backend.client
+
+
+def test_read_replicas_least_latency():
+    """Verify that unreachable replicas are avoided."""
+    settings = dict(TEST_CONFIG)
+    settings['replica_strategy'] = 'least_latency'
+    redis_backend = RedisBackend(settings)
+    down, up = mock.Mock(), mock.Mock()
+    down.ping.side_effect = redis.ConnectionError
+    redis_backend._replicas = [down, up]
+    redis_backend._replicas_pid = os.getpid()
+
+    assert redis_backend.get_read_client() is up
+
+
+def test_get_state_reads_from_replica():
+    """Verify that read-only calls use the replica."""
+    redis_backend = RedisBackend(TEST_CONFIG)
+    redis_backend.client = mock.Mock()
+    replica = mock.Mock()
+    redis_backend._replicas = [replica]
+    redis_backend._replicas_pid = os.getpid()
+
+    redis_backend.get_state('my_id')
+    assert replica.get.called is True
+    assert redis_backend.client.get.called is False
+
+    redis_backend.get_state('my_id', primary=True)
+    assert redis_backend.client.get.called is True
+
+
+def test_delete_jobs_unlink():
+    """Verify that keys are deleted with DEL unless use_unlink is set."""
+    for use_unlink in (False, True):
+        redis_backend = RedisBackend(dict(TEST_CONFIG, use_unlink=use_unlink))
+        redis_backend.client = mock.Mock()
+        fake_pipeline = redis_backend.client.pipeline.return_value
+
+        redis_backend.delete_jobs(['my_id'])
+
+        assert fake_pipeline.delete.called is not use_unlink
+        assert fake_pipeline.execute_command.called is use_unlink
+
+
+def _get_direct_calls(client):
+    """Return the names of the commands sent outside of a pipeline."""
+    return [name for name, _, _ in client.method_calls
+            if not name.startswith("pipeline")]
+
+
+def test_add_one_progress_state_pipeline():
+    """Verify that an increment is written in one round trip."""
+    redis_backend = RedisBackend(dict(TEST_CONFIG, heartbeat_enabled=True))
+    redis_backend.client = mock.Mock()
+
+    redis_backend.add_one_progress_state('my_id', states.SUCCESS)
+
+    pipeline = redis_backend.client.pipeline.return_value
+    assert _get_direct_calls(redis_backend.client) == []
+    assert pipeline.execute.call_count == 1
+    assert pipeline.incr.called is True
+
+
+def test_add_one_progress_state_pipeline_expiration():
+    """Verify that the expiry index is updated in the same pipeline."""
+    redis_backend = RedisBackend(dict(TEST_CONFIG, expiration=60))
+    redis_backend.client = mock.Mock()
+
+    redis_backend.add_one_progress_state('my_id', states.SUCCESS)
+
+    pipeline = redis_backend.client.pipeline.return_value
+    assert _get_direct_calls(redis_backend.client) == []
+    assert pipeline.execute_command.call_args[0][:2] == (
+        "ZADD", redis_backend._get_key_for_index("expiry"))
+    assert pipeline.execute.call_count == 1
+
+
+def test_initialize_hash_data():
+    """Verify that values redis-py 3 rejects are stored as strings."""
+    redis_backend = RedisBackend(dict(TEST_CONFIG))
+    redis_backend.client = mock.Mock()
+
+    redis_backend.initialize_job(
+        'my_id', {'flag': True, 'x': None, 'n': 1, 's': 'a'},
+        states.PENDING, 42)
+
+    pipeline = redis_backend.client.pipeline.return_value
+    pipeline.hmset.assert_called_once_with(
+        mock.ANY, {'flag': 'True', 'x': 'None', 'n': 1, 's': 'a'})
@@ -0,0 +1,42 @@
+import pytest
+
+from job_progress import serializers
+
+DATA = {"name": "toaster", "count": 3, "nested": {"slices": [1, 2.5]}}
+
+
+def test_json_round_trip():
+    """Verify that types survive a round trip."""
+    serializer = serializers.get_serializer("json")
+
+    assert serializer.loads(serializer.dumps(DATA)) == DATA
+
+
+def test_compression_threshold():
+    """Verify that only big payloads are compressed."""
+    serializer = serializers.get_serializer("json", compression_threshold=64)
+    big = {"toasts": ["bread"] * 100}
+
+    small_payload = serializer.dumps(DATA)
+    big_payload = serializer.dumps(big)
+
+    assert small_payload.startswith(serializers.RAW)
+    assert big_payload.startswith(serializers.COMPRESSED)
+    assert len(big_payload) < len(serializers.JSONSerializer().dumps(big))
+    assert serializer.loads(small_payload) == DATA
+    assert serializer.loads(big_payload) == big
+
+
+def test_unknown_serializer():
+    """Verify that we raise a ValueError on unknown serializer."""
+    with pytest.raises(ValueError):
+        serializers.get_serializer("toaster")
+
+
+def test_lazy_data():
+    """Verify that lazy data is deserialized on load."""
+    serializer = serializers.get_serializer("json")
+
+    assert serializers.LazyData(None, serializer).load() == {}
+    lazy = serializers.LazyData(serializer.dumps(DATA), serializer)
+    assert lazy.load() == DATA
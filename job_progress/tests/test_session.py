@@ -0,0 +1,57 @@
+import mock
+
+from job_progress import Session, states
+
+
+def _make_backend():
+    backend = mock.Mock()
+    backend.get_data.return_value = {
+        "data": {},
+        "amount": 1,
+        "state": states.PENDING,
+        "previous_state": states.PENDING,
+    }
+    backend.get_ids.return_value = ['my_id']
+    return backend
+
+
+def test_read_your_writes():
+    """Verify that written jobs are read from the primary."""
+    backend = _make_backend()
+    session = Session(backend, read_your_writes=True)
+
+    session.get('other_id').amount
+    backend.get_data.assert_called_with('other_id', primary=False,
+                                        fields=('amount',))
+
+    session.pin('my_id')
+    job = session.get('my_id')
+    job.amount
+    backend.get_data.assert_called_with('my_id', primary=True,
+                                        fields=('amount',))
+    assert job.session is session
+
+    job.state
+    backend.get_state.assert_called_with('my_id', primary=True)
+
+    session.query(state=states.PENDING)
+    backend.get_ids.assert_called_with(primary=True, state=states.PENDING)
+
+
+def test_read_your_writes_window():
+    """Verify that jobs are only pinned for a while."""
+    backend = _make_backend()
+    session = Session(backend, read_your_writes=True,
+                      read_your_writes_window=-1)
+
+    session.pin('my_id')
+    assert session.is_pinned('my_id') is False
+    assert session.has_pins() is False
+
+
+def test_read_your_writes_disabled():
+    """Verify that pins are ignored by default."""
+    session = Session(_make_backend())
+
+    session.pin('my_id')
+    assert session.is_pinned('my_id') is False
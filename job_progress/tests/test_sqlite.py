@@ -0,0 +1,133 @@
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+from job_progress import JobProgress, Session, states
+from job_progress.backends.sqlite import SQLiteBackend
+
+
+@pytest.fixture
+def sqlite_session(request, tmpdir):
+    backend = SQLiteBackend({
+        "database": str(tmpdir.join("jobs.db")),
+        "heartbeat_enabled": True,
+        "history_enabled": True,
+    })
+    request.addfinalizer(backend.close)
+    return Session(backend)
+
+
+def test_flow(sqlite_session):
+    """Verify that the whole flow works."""
+    data = {"toaster": "bidule", "slices": [1, 2]}
+    job = JobProgress(data=data, amount=3, session=sqlite_session)
+
+    job.state = states.STARTED
+    job.add_one_success()
+    job.add_one_failure()
+    assert job.is_staled is False
+    assert sqlite_session.backend.transition_jobs(
+        [job.id], states.STARTED, [states.PENDING]) == []
+    version, = sqlite_session.backend.get_versions([job.id])
+    sqlite_session.backend.set_amount(job.id, 3)
+    assert sqlite_session.backend.get_versions([job.id]) == [version + 1]
+    age, unknown = sqlite_session.backend.get_heartbeat_ages([job.id, "-"])
+    assert 0 <= age < 60
+    assert unknown is None
+
+    job_id = job.id
+    del job
+    sqlite_session.clear()
+    job = sqlite_session.get(job_id)
+
+    assert job.to_dict() == {
+        'amount': 3,
+        'data': data,
+        'id': job_id,
+        'is_ready': False,
+        'progress': {'SUCCESS': 1, 'FAILURE': 1, 'PENDING': 1},
+        'state': 'STARTED',
+    }
+    assert [state for state, _ in job.history()] == [
+        states.PENDING, states.STARTED]
+
+    job.delete()
+    assert sqlite_session.query() == []
+
+
+def test_indexes(sqlite_session):
+    """Verify that jobs can be queried."""
+    job = JobProgress(amount=1, session=sqlite_session)
+    other = JobProgress(amount=1, session=sqlite_session)
+    other.state = states.SUCCESS
+
+    assert sqlite_session.query(state=states.PENDING) == [job]
+    assert sqlite_session.query(is_ready=True) == [other]
+    assert sqlite_session.query(is_ready=False) == [job]
+    assert len(sqlite_session.query()) == 2
+    assert sqlite_session.count() == 2
+    assert sqlite_session.count(is_ready=False) == 1
+
+    with pytest.raises(TypeError):
+        sqlite_session.query(toaster=True)
+
+
+def test_batched_writes(tmpdir):
+    """Verify that increments are buffered and visible to readers."""
+    database = str(tmpdir.join("jobs.db"))
+    writer = SQLiteBackend({"database": database,
+                            "write_batch_interval": 60})
+    reader = SQLiteBackend({"database": database})
+
+    writer.initialize_job("a", {}, states.STARTED, 10)
+    for _ in range(5):
+        writer.add_one_progress_state("a", states.SUCCESS)
+
+    assert reader.get_progress("a") == {}
+    assert writer.get_progress("a") == {states.SUCCESS: 5}
+    assert reader.get_progress("a") == {states.SUCCESS: 5}
+
+    writer.close()
+    reader.close()
+
+
+def test_batched_writes_retry(tmpdir):
+    """Verify that increments which failed to be written are kept."""
+    database = str(tmpdir.join("jobs.db"))
+    writer = SQLiteBackend({"database": database, "busy_timeout": 0,
+                            "write_batch_interval": 60})
+    reader = SQLiteBackend({"database": database})
+    writer.initialize_job("a", {}, states.STARTED, 10)
+    for _ in range(2):
+        writer.add_one_progress_state("a", states.SUCCESS)
+
+    reader.connection.execute("BEGIN IMMEDIATE")
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    reader.connection.execute("ROLLBACK")
+
+    writer.add_one_progress_state("a", states.SUCCESS)
+    writer.flush()
+    assert reader.get_progress("a") == {states.SUCCESS: 3}
+
+    writer.close()
+    reader.close()
+
+
+def test_batched_writes_at_exit(tmpdir):
+    """Verify that buffered increments are written at exit."""
+    database = str(tmpdir.join("jobs.db"))
+    SQLiteBackend({"database": database}).initialize_job(
+        "a", {}, states.STARTED, 10)
+
+    subprocess.check_call([sys.executable, "-c", (
+        "from job_progress.backends.sqlite import SQLiteBackend\n"
+        "writer = SQLiteBackend({'database': %r,\n"
+        "                        'write_batch_interval': 60})\n"
+        "writer.add_one_progress_state('a', 'SUCCESS')\n") % database])
+
+    reader = SQLiteBackend({"database": database})
+    assert reader.get_progress("a") == {states.SUCCESS: 1}
+    reader.close()
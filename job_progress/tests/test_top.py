@@ -0,0 +1,59 @@
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import mock
+import pytest
+
+from job_progress import states
+from job_progress.tests.fixtures.jobprogress import JobProgress, session
+from job_progress.top import Top
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+def test_refresh():
+    """Verify that frames show progress, rate and heartbeat."""
+    job = JobProgress(amount=4)
+    job.state = states.STARTED
+    JobProgress(amount=1)
+    out = StringIO()
+    top = Top(session.backend, {"state": states.STARTED}, out=out)
+
+    assert top.refresh(now=100) == 1
+    job.add_one_success()
+    job.add_one_failure()
+    assert top.refresh(now=102) == 1
+
+    first, second = out.getvalue().split("1 jobs\n")[:2]
+    assert "0/4" in first
+    assert "STARTED" in first and "s ago" in first
+    assert "2/4" in second and "50%" in second and "1.0/s" in second
+
+
+def test_refresh_without_heartbeats():
+    """Verify that heartbeats are not read when jobs do not send them."""
+    job = JobProgress(amount=1)
+    job.state = states.STARTED
+    out = StringIO()
+    top = Top(session.backend, out=out, heartbeats=False)
+
+    with mock.patch.object(session.backend, "get_snapshots",
+                           wraps=session.backend.get_snapshots) as snapshots:
+        assert top.refresh() == 1
+    assert snapshots.call_args[1]["with_heartbeat_ages"] is False
+    assert "staled" not in out.getvalue()
+
+
+def test_refresh_batches():
+    """Verify that the index is walked, one pipeline per batch."""
+    ids = set(JobProgress(amount=1).id for _ in range(3))
+    out = StringIO()
+    top = Top(session.backend, batch_size=1, out=out)
+
+    with mock.patch.object(session.backend, "get_ids") as get_ids, \
+            mock.patch.object(session.backend, "get_heartbeat_ages") as ages:
+        assert top.refresh() == 3
+    assert not get_ids.called and not ages.called
+    assert set(top._done) == ids
@@ -0,0 +1,58 @@
+import mock
+
+from job_progress import states
+from job_progress.unit_of_work import UnitOfWork
+
+
+def test_coalesce():
+    """Verify that queued writes are coalesced."""
+    unit_of_work = UnitOfWork()
+    unit_of_work.transition("a", states.PENDING, states.STARTED)
+    unit_of_work.transition("a", states.STARTED, states.SUCCESS)
+    unit_of_work.increment("a", states.SUCCESS)
+    unit_of_work.increment("a", states.SUCCESS, 2)
+    unit_of_work.transition("b", states.PENDING, states.STARTED)
+    unit_of_work.increment("b", states.FAILURE)
+    unit_of_work.delete("b", states.PENDING)
+
+    assert unit_of_work.transitions == {
+        "a": [states.PENDING, states.SUCCESS, True]}
+    assert unit_of_work.increments == {"a": {states.SUCCESS: 3}}
+    assert unit_of_work.deletes == {"b": states.PENDING}
+    assert unit_of_work.get_state("a") == states.SUCCESS
+    assert unit_of_work.get_state("b") is None
+
+
+def test_flush():
+    """Verify that flushing writes to the backend once."""
+    backend = mock.Mock()
+    unit_of_work = UnitOfWork()
+
+    unit_of_work.flush(backend)
+    assert backend.flush_changes.called is False
+
+    unit_of_work.increment("a", states.SUCCESS)
+    unit_of_work.flush(backend)
+    backend.flush_changes.assert_called_once_with(unit_of_work)
+    assert len(unit_of_work) == 0
+
+
+def test_token():
+    """Verify that the token is kept until the writes are flushed."""
+    backend = mock.Mock()
+    assert UnitOfWork().token is None
+
+    unit_of_work = UnitOfWork(idempotent=True)
+    token = unit_of_work.token
+    unit_of_work.increment("a", states.SUCCESS)
+
+    backend.flush_changes.side_effect = IOError
+    try:
+        unit_of_work.flush(backend)
+    except IOError:
+        pass
+    assert unit_of_work.token == token
+
+    backend.flush_changes.side_effect = None
+    unit_of_work.flush(backend)
+    assert unit_of_work.token not in (None, token)
@@ -0,0 +1,38 @@
+from job_progress import states, utils
+
+
+def test_compute_durations():
+    """Verify that durations are summed per state."""
+    history = [
+        (states.PENDING, 10.0),
+        (states.STARTED, 12.0),
+        (states.PENDING, 15.0),
+        (states.STARTED, 16.0),
+    ]
+
+    assert utils.compute_durations(history, now=20.0) == {
+        states.PENDING: 3.0,
+        states.STARTED: 7.0,
+    }
+
+    history.append((states.SUCCESS, 21.0))
+    assert utils.compute_durations(history, now=30.0) == {
+        states.PENDING: 3.0,
+        states.STARTED: 8.0,
+    }
+    assert utils.compute_durations([]) == {}
+
+
+def test_hybridproperty():
+    """Verify that hybrid properties resolve against classes and instances."""
+    class Toaster(object):
+        name = "class"
+
+        @utils.hybridproperty
+        def label(self_or_cls):
+            return self_or_cls.name
+
+    toaster = Toaster()
+    toaster.name = "instance"
+    assert Toaster.label == "class"
+    assert toaster.label == "instance"
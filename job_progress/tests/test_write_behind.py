@@ -0,0 +1,167 @@
+import os
+import subprocess
+import sys
+
+import mock
+import pytest
+
+from job_progress import JobProgress, Session, states
+from job_progress.backends.redis import RedisBackend
+from job_progress.tests.fixtures.jobprogress import TEST_CONFIG
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+def _make_session(spool_path):
+    backend = RedisBackend(dict(TEST_CONFIG,
+                                write_behind=True,
+                                write_behind_max_size=2,
+                                write_behind_spool_path=spool_path,
+                                write_behind_interval=60,
+                                write_behind_batch_size=2))
+    return Session(backend)
+
+
+def test_write_behind(tmpdir):
+    """Verify that writes are queued, spooled, then written in order."""
+    spool_path = str(tmpdir.join("spool"))
+    session = _make_session(spool_path)
+    job = JobProgress(amount=4, session=session)
+
+    job.state = states.STARTED
+    for _ in range(3):
+        job.add_one_success()
+    job.state = states.SUCCESS
+    job.add_one_failure()
+
+    assert os.path.exists(spool_path)
+    assert job.state == states.PENDING
+    assert job.get_progress() == {states.PENDING: 4}
+
+    session.backend.flush()
+
+    assert job.state == states.SUCCESS
+    assert job.get_progress() == {states.SUCCESS: 3, states.FAILURE: 1}
+    assert [j.id for j in session.query(state=states.SUCCESS)] == [job.id]
+    assert session.count(state=states.STARTED) == 0
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_write_behind_retry(tmpdir):
+    """Verify that failed batches are written again."""
+    session = _make_session(str(tmpdir.join("spool")))
+    job = JobProgress(amount=2, session=session)
+    job.add_one_success()
+
+    with mock.patch.object(session.backend, "flush_changes",
+                           side_effect=IOError):
+        try:
+            session.backend.flush()
+        except IOError:
+            pass
+
+    job.add_one_success()
+    session.backend.flush()
+    assert job.get_progress() == {states.SUCCESS: 2}
+
+
+def test_write_behind_retry_applied(tmpdir):
+    """Verify that batches which reached Redis are not counted twice."""
+    session = _make_session(str(tmpdir.join("spool")))
+    job = JobProgress(amount=2, session=session)
+    job.add_one_success()
+    flush_changes = session.backend.flush_changes
+
+    def time_out(changes):
+        flush_changes(changes)
+        raise IOError()
+
+    with mock.patch.object(session.backend, "flush_changes",
+                           side_effect=time_out):
+        try:
+            session.backend.flush()
+        except IOError:
+            pass
+
+    job.add_one_success()
+    session.backend.flush()
+    assert job.get_progress() == {states.SUCCESS: 2}
+
+
+def test_write_behind_recovery(tmpdir):
+    """Verify that a spool left by a previous process is written first."""
+    spool_path = str(tmpdir.join("spool"))
+    session = _make_session(spool_path)
+    job = JobProgress(amount=2, session=session)
+    with open(spool_path, "w") as spool:
+        spool.write('["progress", "jobprogress", "%s", "SUCCESS", 1]\n'
+                    '["state", "jobprogress", "%s", "STARTED", "PEN'
+                    % (job.id, job.id))
+
+    session = _make_session(spool_path)
+    session.backend.set_state(job.id, states.SUCCESS, states.PENDING)
+    session.backend.flush()
+
+    assert job.get_progress() == {states.SUCCESS: 1, states.PENDING: 1}
+    assert [j.id for j in session.query(state=states.SUCCESS)] == [job.id]
+
+
+def test_write_behind_at_exit(tmpdir):
+    """Verify that writes left at exit are written, or saved to the spool."""
+    spool_path = str(tmpdir.join("spool"))
+    session = _make_session(spool_path)
+    job = JobProgress(amount=2, session=session)
+    queue = session.backend._write_behind
+
+    with mock.patch("atexit.register") as register:
+        job.add_one_success()
+        job.add_one_success()
+    register.assert_called_once_with(queue._stop_at_exit)
+
+    with mock.patch.object(session.backend, "flush_changes",
+                           side_effect=IOError):
+        queue._stop_at_exit()
+    assert len(queue) == 0
+    assert job.get_progress() == {states.PENDING: 2}
+
+    session = _make_session(spool_path)
+    session.backend.flush()
+    assert job.get_progress() == {states.SUCCESS: 2}
+
+
+def test_write_behind_adopt_spools(tmpdir):
+    """Verify that spools left by exited children are written in order."""
+    spool_path = str(tmpdir.join("spool"))
+    child = subprocess.Popen([sys.executable, "-c", "pass"])
+    child.wait()
+    job = JobProgress(amount=2, session=_make_session(spool_path))
+    with open("%s.%s.draining" % (spool_path, child.pid), "w") as spool:
+        spool.write('["state", "jobprogress", "%s", "STARTED", "PENDING"]\n'
+                    '["progress", "jobprogress", "%s", "SUCCESS", 1]\n'
+                    % (job.id, job.id))
+    with open("%s.%s" % (spool_path, child.pid), "w") as spool:
+        spool.write('["state", "jobprogress", "%s", "SUCCESS", "STARTED"]\n'
+                    % job.id)
+
+    session = _make_session(spool_path)
+    session.backend.flush()
+
+    assert job.get_progress() == {states.SUCCESS: 1, states.PENDING: 1}
+    assert [j.id for j in session.query(state=states.SUCCESS)] == [job.id]
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_write_behind_delete(tmpdir):
+    """Verify that deleting a job does not wait on Redis."""
+    session = _make_session(str(tmpdir.join("spool")))
+    job = JobProgress(amount=2, session=session)
+    job.state = states.STARTED
+
+    with mock.patch.object(session.backend, "flush_changes",
+                           side_effect=IOError):
+        job.delete()
+
+    session.backend.flush()
+    assert session.backend.get_state(job.id) is None
+    assert session.count() == 0
+    assert session.count(state=states.STARTED) == 0
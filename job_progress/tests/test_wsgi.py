@@ -0,0 +1,90 @@
+import json
+
+import mock
+import pytest
+
+from job_progress import states
+from job_progress.tests.fixtures.jobprogress import JobProgress, session
+from job_progress.wsgi import ProgressApp
+
+pytestmark = pytest.mark.usefixtures("flushdb")
+
+
+def _get(app, path="/", query_string="", **headers):
+    environ = {"REQUEST_METHOD": "GET", "PATH_INFO": path,
+               "QUERY_STRING": query_string}
+    environ.update(headers)
+    start_response = mock.Mock()
+    body = b"".join(app(environ, start_response))
+    status, response_headers = start_response.call_args[0]
+    return int(status.split()[0]), dict(response_headers), body
+
+
+def test_get_job():
+    """Verify that a job is served with its version as ETag."""
+    job = JobProgress(amount=2)
+    job.state = states.STARTED
+    job.add_one_progress_state(states.SUCCESS)
+    app = ProgressApp(session, cache_ttl=0)
+
+    status, headers, body = _get(app, "/%s" % job.id)
+    assert status == 200
+    assert json.loads(body.decode("utf-8"))["progress"] == {
+        states.SUCCESS: 1, states.PENDING: 1}
+
+    status, headers, body = _get(app, "/%s" % job.id,
+                                 HTTP_IF_NONE_MATCH=headers["ETag"])
+    assert status == 304
+    assert body == b""
+
+    job.add_one_progress_state(states.SUCCESS)
+    status, new_headers, body = _get(app, "/%s" % job.id,
+                                     HTTP_IF_NONE_MATCH=headers["ETag"])
+    assert status == 200
+    assert new_headers["ETag"] != headers["ETag"]
+
+    assert _get(app, "/unknown")[0] == 404
+
+
+def test_get_job_cached():
+    """Verify that unchanged jobs are served from the cache."""
+    job = JobProgress(amount=2)
+    app = ProgressApp(session, cache_ttl=0)
+    _get(app, "/%s" % job.id)
+
+    with mock.patch.object(session.backend, "get_snapshots") as snapshots:
+        assert _get(app, "/%s" % job.id)[0] == 200
+    assert not snapshots.called
+
+    app.cache.ttl = 60
+    with mock.patch.object(session.backend, "get_versions") as versions:
+        assert _get(app, "/%s" % job.id)[0] == 200
+    assert not versions.called
+
+
+def test_get_jobs():
+    """Verify that jobs are listed by filters."""
+    job = JobProgress(amount=2)
+    app = ProgressApp(session)
+
+    status, _, body = _get(app, query_string="state=PENDING")
+    assert status == 200
+    assert [j["id"] for j in json.loads(body.decode("utf-8"))] == [job.id]
+
+    status, _, body = _get(app, query_string="is_ready=true")
+    assert json.loads(body.decode("utf-8")) == []
+
+    assert _get(app, query_string="amount=2")[0] == 400
+
+
+def test_get_job_amount_changed():
+    """Verify that changing the amount invalidates the ETag."""
+    job = JobProgress(amount=2)
+    app = ProgressApp(session, cache_ttl=0)
+    _, headers, _ = _get(app, "/%s" % job.id)
+
+    session.backend.set_amount(job.id, 3)
+    status, _, body = _get(app, "/%s" % job.id,
+                           HTTP_IF_NONE_MATCH=headers["ETag"])
+    assert status == 200
+    assert json.loads(body.decode("utf-8"))["amount"] == 3
@@ -0,0 +1,178 @@
+"""
+Live view of jobs, refreshed on an interval::
+
+    job-progress-top --url redis://localhost:6379/0 --state STARTED
+
+Each refresh walks the index with SSCAN, and reads each batch of jobs,
+heartbeats included, in one pipeline. Rows are printed as batches arrive;
+only the progress of each job at the previous refresh is kept, for the
+rate column. Reads go to replicas when ``--replica`` is given.
+
+Heartbeat ages derive from the TTL of the heartbeat keys, so
+``--heartbeat-expiration`` must match the setting of the writers. Without
+heartbeats, ``--no-heartbeats`` skips reading them.
+
+When the output is not a terminal, or with ``--once``, frames are
+streamed one after the other instead of redrawn.
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import sys
+import time
+
+from job_progress import states
+from job_progress.backends.redis import RedisBackend
+from job_progress.utils import compute_progress
+
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+ROW_FORMAT = "%-36s  %-9s  %15s  %6s  %9s  %s"
+HEADER = ROW_FORMAT % ("ID", "STATE", "PROGRESS", "", "RATE", "HEARTBEAT")
+
+
+def format_heartbeat(state, age, heartbeats=True):
+    """Return a heartbeat column."""
+    if not heartbeats:
+        return "-"
+    if age is not None:
+        return "%ds ago" % age
+    if state == states.STARTED:
+        return "staled"
+    return "-"
+
+
+class Top(object):
+
+    """
+    Print frames of jobs.
+
+    :param backend:
+    :param dict filters: filters passed to ``iter_ids``.
+    :param int batch_size: amount of jobs per pipeline.
+    :param bool primary: if ``False``, reads may go to replicas.
+    :param out: file to print to.
+    :param bool heartbeats: if ``False``, heartbeats are not read.
+    """
+
+    def __init__(self, backend, filters=None, batch_size=500, primary=True,
+                 out=sys.stdout, heartbeats=True):
+        self.backend = backend
+        self.filters = filters or {}
+        self.batch_size = batch_size
+        self.primary = primary
+        self.out = out
+        self.heartbeats = heartbeats
+        #: id -> amount of finished units at the previous refresh
+        self._done = {}
+        self._refreshed_at = None
+
+    def iter_rows(self):
+        """Yield ``(id, state, amount, progress, heartbeat age)`` tuples."""
+        for ids in self.backend.iter_ids(self.batch_size,
+                                         primary=self.primary,
+                                         **self.filters):
+            rows = self.backend.get_snapshots(
+                ids, primary=self.primary, with_data=False,
+                with_heartbeat_ages=self.heartbeats)
+            for row in rows:
+                id_, state, amount, _, progress = row[:5]
+                if state is None:
+                    # Deleted meanwhile.
+                    continue
+                age = row[5] if self.heartbeats else None
+                yield (id_, state, amount,
+                       compute_progress(progress, amount), age)
+
+    def refresh(self, now=None):
+        """Print a frame.
+
+        :rtype: int, the amount of printed jobs.
+        """
+        now = time.time() if now is None else now
+        elapsed = now - self._refreshed_at if self._refreshed_at else None
+        done = {}
+        count = 0
+
+        self.out.write(HEADER + "\n")
+        for id_, state, amount, progress, age in self.iter_rows():
+            if id_ in done:
+                # Seen twice while walking the index.
+                continue
+            finished = sum(c for s, c in progress.items()
+                           if s != states.PENDING)
+            amount = int(amount or 0)
+            percent = 100 * finished // amount if amount else 0
+
+            rate = ""
+            previous = self._done.get(id_)
+            if elapsed and previous is not None:
+                rate = "%.1f/s" % ((finished - previous) / elapsed)
+
+            self.out.write(ROW_FORMAT % (
+                id_, state, "%d/%d" % (finished, amount), "%d%%" % percent,
+                rate, format_heartbeat(state, age, self.heartbeats)) + "\n")
+            done[id_] = finished
+            count += 1
+
+        self.out.write("%d jobs\n" % count)
+        self.out.flush()
+        self._done = done
+        self._refreshed_at = now
+        return count
+
+
+def main(argv=None):
+    """Show jobs until interrupted."""
+    parser = argparse.ArgumentParser(prog="job-progress-top",
+                                     description="Live view of jobs")
+    parser.add_argument("--url", default="redis://localhost:6379/0")
+    parser.add_argument("--namespace", default=None)
+    parser.add_argument("--state", choices=sorted(states.ALL_STATES))
+    ready = parser.add_mutually_exclusive_group()
+    ready.add_argument("--ready", dest="is_ready", action="store_const",
+                       const=True)
+    ready.add_argument("--not-ready", dest="is_ready", action="store_const",
+                       const=False)
+    parser.add_argument("--interval", type=float, default=2,
+                        help="seconds between refreshes")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--replica", action="append", default=[],
+                        help="read replica URL, may be repeated")
+    parser.add_argument("--once", action="store_true",
+                        help="print a single frame")
+    heartbeats = parser.add_mutually_exclusive_group()
+    heartbeats.add_argument("--heartbeat-expiration", type=int,
+                            help="heartbeat_expiration of the writers, in "
+                                 "seconds")
+    heartbeats.add_argument("--no-heartbeats", dest="heartbeats",
+                            action="store_false",
+                            help="jobs do not send heartbeats")
+    args = parser.parse_args(argv)
+
+    settings = {"backend_url": args.url, "replica_urls": args.replica}
+    if args.heartbeat_expiration is not None:
+        settings["heartbeat_expiration"] = args.heartbeat_expiration
+    if args.namespace:
+        settings["namespace"] = args.namespace
+    filters = {}
+    if args.state:
+        filters["state"] = args.state
+    if args.is_ready is not None:
+        filters["is_ready"] = args.is_ready
+
+    top = Top(RedisBackend(settings), filters, args.batch_size,
+              primary=not args.replica, heartbeats=args.heartbeats)
+    redraw = not args.once and sys.stdout.isatty()
+    try:
+        while True:
+            if redraw:
+                sys.stdout.write(CLEAR_SCREEN)
+            top.refresh()
+            if args.once:
+                return 0
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
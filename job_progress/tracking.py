@@ -0,0 +1,117 @@
+"""
+Progress tracking over any iterable.
+
+Instead of::
+
+    with job.run():
+        for bread in breads:
+            try:
+                toast(bread)
+                job.add_one_success()
+            except Exception:
+                job.add_one_failure()
+
+Write::
+
+    tracker = job.track(breads)
+    for bread in tracker:
+        try:
+            toast(bread)
+        except Exception:
+            tracker.mark_failure()
+
+Counts are written by batches rather than once per item.
+"""
+from __future__ import absolute_import
+import time
+
+from job_progress import states
+from job_progress.unit_of_work import UnitOfWork
+
+
+class ProgressTracker(object):
+
+    """
+    Iterate over ``iterable``, tracking the progress of ``job``.
+
+    - The job's amount is set to ``len(iterable)`` when available.
+    - The job is STARTED when iteration starts.
+    - Each item counts as a success once the next one is requested, unless
+      :meth:`mark_failure` was called while processing it.
+    - Counts are written once ``batch_size`` items were processed or
+      ``interval`` seconds elapsed since the last write, in one pipeline.
+    - The job is set to SUCCESS when the iterable is exhausted. If
+      iteration is interrupted (by an exception or a ``break``), the
+      current item counts as a failure and the job is set to FAILURE.
+
+    :param JobProgress job:
+    :param iterable:
+    :param int batch_size: amount of items between writes.
+    :param float interval: maximum amount of seconds between writes.
+    """
+
+    def __init__(self, job, iterable, batch_size=100, interval=1.0):
+        self.job = job
+        self.iterable = iterable
+        self.batch_size = batch_size
+        self.interval = interval
+        self._buffer = UnitOfWork()
+        self._buffered = 0
+        self._flushed_at = None
+        self._processing = False
+        self._failed = False
+
+    def __iter__(self):
+        self._start()
+        completed = False
+        try:
+            for item in self.iterable:
+                self._processing = True
+                yield item
+                if self._count():
+                    self.flush()
+            completed = True
+        finally:
+            self._finish(completed)
+
+    def mark_failure(self):
+        """Count the current item as a failure."""
+        self._failed = True
+
+    def flush(self):
+        """Write buffered counts."""
+        self._buffer.flush(self.job.backend)
+        self._buffered = 0
+        self._flushed_at = time.time()
+
+    def _start(self):
+        try:
+            amount = len(self.iterable)
+        except TypeError:
+            pass
+        else:
+            current = self.job.amount
+            # Amounts read from Redis are strings.
+            if current is None or int(current) != amount:
+                self.job.backend.set_amount(self.job.id, amount)
+                self.job.amount = amount
+
+        self._flushed_at = time.time()
+        self.job.state = states.STARTED
+
+    def _count(self):
+        """Count the current item, return True if a write is due."""
+        state = states.FAILURE if self._failed else states.SUCCESS
+        self._buffer.increment(self.job.id, state)
+        self._buffered += 1
+        self._processing = False
+        self._failed = False
+        return (self._buffered >= self.batch_size or
+                time.time() - self._flushed_at >= self.interval)
+
+    def _finish(self, completed):
+        if self._processing:
+            self._failed = True
+            self._count()
+        self.flush()
+        self.job.state = states.SUCCESS if completed else states.FAILURE
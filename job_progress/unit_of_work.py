@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+import uuid
+
+from job_progress import states
+
+
+def new_token():
+    """Return a new token for idempotent increments."""
+    return uuid.uuid4().hex
+
+
+class UnitOfWork(object):
+
+    """
+    Writes queued for many jobs, coalesced and flushed in one pipeline.
+
+    - Successive transitions of a job collapse into a single one, from the
+      state the job was in before the first transition to the last state,
+      so that the index is moved once.
+    - Progress increments are summed per job and state.
+    - Deleting a job drops its other queued writes.
+
+    :param bool idempotent: if ``True``, increments carry a token and are
+        applied at most once per token, so that a flush that failed, e.g.
+        on a timeout, can be retried without counting twice. The token is
+        renewed once the writes are flushed.
+    """
+
+    def __init__(self, idempotent=False):
+        self.idempotent = idempotent
+        #: token of the increments, ``None`` unless idempotent
+        self.token = new_token() if idempotent else None
+        #: id -> [previous state, state, went through STARTED]
+        self.transitions = {}
+        #: id -> {state: count}
+        self.increments = {}
+        #: id -> state the job was in before the unit of work
+        self.deletes = {}
+
+    def __len__(self):
+        return len(self.transitions) + len(self.increments) + len(self.deletes)
+
+    def transition(self, id_, previous_state, state):
+        """Queue a state transition."""
+        transition = self.transitions.get(id_)
+        if transition is None:
+            self.transitions[id_] = [previous_state, state,
+                                     state == states.STARTED]
+        else:
+            transition[1] = state
+            transition[2] = transition[2] or state == states.STARTED
+
+    def increment(self, id_, state, count=1):
+        """Queue a progress increment."""
+        counts = self.increments.setdefault(id_, {})
+        counts[state] = counts.get(state, 0) + count
+
+    def delete(self, id_, state):
+        """Queue the deletion of a job.
+
+        :param str state: state of the job, queued transitions excepted.
+        """
+        transition = self.transitions.pop(id_, None)
+        if transition is not None:
+            state = transition[0]
+        self.increments.pop(id_, None)
+        self.deletes[id_] = state
+
+    def get_state(self, id_):
+        """Return the queued state of a job, ``None`` if there is none."""
+        transition = self.transitions.get(id_)
+        if transition is not None:
+            return transition[1]
+        return None
+
+    def clear(self):
+        """Forget every queued write."""
+        self.transitions.clear()
+        self.increments.clear()
+        self.deletes.clear()
+        if self.idempotent:
+            self.token = new_token()
+
+    def flush(self, backend):
+        """Write queued changes to ``backend``, then forget them."""
+        if self:
+            backend.flush_changes(self)
+        self.clear()
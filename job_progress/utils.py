@@ -1,3 +1,5 @@
+import time
+
 from job_progress import states
 
 
@@ -13,12 +15,65 @@ def fail_staled_jobs(session):
             job.state = states.FAILURE
 
 
+def reconcile_indexes(session, batch_size=500, max_batches_per_second=None):
+    """Repair the backend's indexes and return what was repaired.
+
+    See :meth:`job_progress.backends.redis.RedisBackend.reconcile_indexes`.
+    """
+    return session.backend.reconcile_indexes(
+        batch_size=batch_size, max_batches_per_second=max_batches_per_second)
+
+
+def prune_expired_jobs(session, batch_size=1000):
+    """Remove expired jobs from the indexes.
+
+    Expiration is controlled through ``expiration``.
+    """
+    return session.backend.prune_expired(batch_size=batch_size)
+
+
+def compute_progress(progress, amount):
+    """Return progress counts, including pending units.
+
+    :param dict progress: progress counts as stored in the backend.
+    :param amount: amount of work to do.
+    """
+    progress = {k: int(v) for k, v in progress.items()}
+
+    pending = 0
+    if amount:
+        # There can be a race condition before we have saved amount.
+        pending = int(amount) - sum(progress.values())
+
+    if pending:
+        progress[states.PENDING] = pending
+
+    return progress
+
+
+def compute_durations(history, now=None):
+    """Return the time, in seconds, spent in each state.
+
+    :param list history: ``(state, timestamp)`` tuples, oldest first.
+    :param float now: current timestamp, used for the current state unless
+        it is a ready state.
+    """
+    durations = {}
+    for (state, started_at), (_, ended_at) in zip(history, history[1:]):
+        durations[state] = durations.get(state, 0) + ended_at - started_at
+
+    if history and history[-1][0] not in states.READY_STATES:
+        state, started_at = history[-1]
+        now = time.time() if now is None else now
+        durations[state] = durations.get(state, 0) + now - started_at
+
+    return durations
+
+
 def cleanup_ready_jobs(session):
     """Cleanup jobs that are ready."""
 
-    jobs = session.query(is_ready=True)
-    for job in jobs:
-        job.delete()
+    return session.delete_where(is_ready=True)
 
 
 class classproperty(object):
@@ -28,3 +83,14 @@ class classproperty(object):
 
     def __get__(self, instance, owner):
         return self.getter(owner)
+
+
+class hybridproperty(classproperty):
+
+    """Like :class:`classproperty`, but resolved against the instance when
+    accessed from one."""
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return super(hybridproperty, self).__get__(instance, owner)
+        return self.getter(instance)
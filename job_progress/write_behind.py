@@ -0,0 +1,368 @@
+"""
+Write-behind queue, so that callers never wait on the backend.
+
+Writes are appended to a bounded queue in memory, and a background thread
+writes them by batches, one pipeline per batch. When the queue is full,
+writes are appended to a local spool file, read back once the queue is
+empty. A spool left by a previous process is written first, and so are
+the spools of forked children which exited before writing theirs.
+
+Writes are kept in order: a failed batch is retried on the next interval
+before anything else. Batches carry a token, kept when they are retried,
+so that progress increments are applied once even if a failed write did
+reach Redis (see :meth:`RedisBackend.add_progress`). Tokens of spooled
+batches derive from the spool file and the batch's offset, so batches
+written again after a crash are skipped too, as long as Redis remembers
+their token. State changes are written again, which is harmless.
+
+What's left is written when the interpreter exits. If that fails, writes
+kept in memory are saved to the spool when there is one, and lost
+otherwise. Processes exiting without running :mod:`atexit` functions, like
+forked children calling :func:`os._exit`, must call
+:meth:`RedisBackend.flush` first.
+"""
+from __future__ import absolute_import
+import atexit
+import collections
+import json
+import errno
+import itertools
+import logging
+import os
+import re
+import threading
+
+from job_progress.periodic import PeriodicThread
+from job_progress.unit_of_work import UnitOfWork, new_token
+
+STATE = "state"
+PROGRESS = "progress"
+DELETE = "delete"
+
+logger = logging.getLogger(__name__)
+
+#: suffix of the spool files of forked children, the first group is the
+#: pid of their owner
+CHILD_SPOOL_SUFFIX = re.compile(r"^\.(\d+)(\.draining|\.adopted\.(\d+))?$")
+
+_adoptions = itertools.count()
+
+
+def _is_running(pid):
+    """Return whether the process ``pid`` is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class WriteBehindQueue(object):
+
+    """
+    Queue writes for a backend.
+
+    Writes are lists, their first item is their kind and the second one
+    the namespace of the job:
+
+    - ``["state", namespace, id, state, previous_state]``
+    - ``["progress", namespace, id, state, count]``
+    - ``["delete", namespace, id, state]``, ``state`` is ``None`` when
+      unknown
+
+    :param RedisBackend backend:
+    :param int max_size: maximum amount of writes kept in memory.
+    :param str spool_path: path of the spool file, which must not be
+        shared by processes. Forked children append their pid to it. If
+        ``None``, callers wait for the queue to have room when it is full.
+        Spools of children which are not running anymore are adopted,
+        renamed after the adopting process.
+    :param float interval: interval in seconds between writes.
+    :param int batch_size: maximum amount of writes per pipeline.
+    """
+
+    def __init__(self, backend, max_size=10000, spool_path=None,
+                 interval=0.1, batch_size=500):
+        self.backend = backend
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self._writes = collections.deque()
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._drain_lock = threading.Lock()
+        self._pid = os.getpid()
+        self._spool_file = None
+        self._draining_offset = 0
+        #: spools adopted from other processes, written first
+        self._adopted = collections.deque()
+        self._adopted_offset = 0
+        #: size and token of the batch being written
+        self._batch = None
+        self._exit_registered = False
+        self._base_spool_path = spool_path
+        self._set_spool_path(spool_path)
+        self._flusher = PeriodicThread(self.drain, interval,
+                                       name="job_progress-write-behind")
+        if self._spooling or self._adopted:
+            self._start()
+
+    def __len__(self):
+        return len(self._writes)
+
+    def _set_spool_path(self, spool_path):
+        self.spool_path = spool_path
+        self._spooling = spool_path is not None and (
+            os.path.exists(spool_path) or
+            os.path.exists(self._draining_path))
+        if spool_path is not None:
+            self._adopt_spools()
+
+    def _adopt_spools(self):
+        """Adopt the spools left by children which are not running."""
+        directory, prefix = os.path.split(self._base_spool_path)
+        found = []
+        for name in os.listdir(directory or os.curdir):
+            match = CHILD_SPOOL_SUFFIX.match(name[len(prefix):])
+            if not name.startswith(prefix) or match is None:
+                continue
+            pid = int(match.group(1))
+            if pid == self._pid or _is_running(pid):
+                continue
+            # Adopted spools come first, then the one being drained.
+            if match.group(3) is not None:
+                rank = (0, int(match.group(3)))
+            else:
+                rank = (1 if match.group(2) else 2, 0)
+            found.append(((pid, rank), os.path.join(directory, name)))
+
+        for _, path in sorted(found):
+            adopted_path = "%s.%s.adopted.%d" % (
+                self._base_spool_path, self._pid, next(_adoptions))
+            try:
+                os.rename(path, adopted_path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # Adopted by another process.
+                continue
+            self._adopted.append(adopted_path)
+
+    @property
+    def _draining_path(self):
+        return self.spool_path + ".draining"
+
+    def _forget_parent(self):
+        """Forget the writes of the parent process, with the lock held."""
+        if self._pid == os.getpid():
+            return
+        self._writes = collections.deque()
+        self._batch = None
+        self._spool_file = None
+        self._draining_offset = 0
+        self._adopted = collections.deque()
+        self._adopted_offset = 0
+        self._pid = os.getpid()
+        if self.spool_path is not None:
+            self._set_spool_path(
+                "%s.%s" % (self._base_spool_path, self._pid))
+
+    def _start(self):
+        """Write in the background, and when the interpreter exits."""
+        self._flusher.start()
+        if not self._exit_registered:
+            # Forked children inherit the registration.
+            self._exit_registered = True
+            atexit.register(self._stop_at_exit)
+
+    def put(self, write):
+        """Queue ``write``."""
+        self._start()
+        with self._lock:
+            self._forget_parent()
+            if self._spooling or (len(self._writes) >= self.max_size and
+                                  self.spool_path is not None):
+                self._spool(write)
+            else:
+                while len(self._writes) >= self.max_size:
+                    self._not_full.wait()
+                self._writes.append(write)
+
+    def _spool(self, write):
+        """Append ``write`` to the spool file, with the lock held."""
+        if self._spool_file is None:
+            self._spool_file = open(self.spool_path, "a+")
+            self._spool_file.seek(0, os.SEEK_END)
+            if self._spool_file.tell():
+                self._spool_file.seek(self._spool_file.tell() - 1)
+                if self._spool_file.read(1) != "\n":
+                    # The last line was cut by a crash.
+                    self._spool_file.write("\n")
+        self._spool_file.write(json.dumps(write) + "\n")
+        self._spool_file.flush()
+        self._spooling = True
+
+    def drain(self):
+        """Write every queued write, a batch at a time."""
+        with self._drain_lock:
+            with self._lock:
+                self._forget_parent()
+            while self._write_batch():
+                pass
+
+    def stop(self):
+        """Stop writing in the background, and write what's left."""
+        self._flusher.stop()
+        self.drain()
+
+    def _stop_at_exit(self):
+        """Write what's left, or save it to the spool."""
+        try:
+            self.stop()
+        except Exception:
+            if self.spool_path is None:
+                logger.exception("Lost %d queued writes", len(self._writes))
+                return
+            logger.exception("Saving %d queued writes to %s",
+                             len(self._writes), self._draining_path)
+            with self._drain_lock:
+                self._save()
+
+    def _save(self):
+        """Move the writes kept in memory to the spool.
+
+        They are written before the spooled writes, after the ones of the
+        spool file being drained, which is rewritten without its lines
+        already written.
+        """
+        with self._lock:
+            if self._spool_file is not None:
+                self._spool_file.close()
+                self._spool_file = None
+            lines = []
+            if os.path.exists(self._draining_path):
+                with open(self._draining_path) as draining:
+                    draining.seek(self._draining_offset)
+                    lines.extend(line for line in draining
+                                 if line.endswith("\n"))
+            lines.extend(json.dumps(write) + "\n" for write in self._writes)
+            saving_path = self._draining_path + ".saving"
+            with open(saving_path, "w") as saving:
+                saving.writelines(lines)
+            os.rename(saving_path, self._draining_path)
+            self._draining_offset = 0
+            self._writes.clear()
+            self._batch = None
+
+    def _write_batch(self):
+        """Write the oldest batch of writes.
+
+        :rtype: bool, ``False`` if there was nothing to write.
+        """
+        if self._adopted:
+            offset = self._write_spool_batch(self._adopted[0],
+                                             self._adopted_offset)
+            if offset is None:
+                self._adopted.popleft()
+            self._adopted_offset = offset or 0
+            return True
+
+        if self.spool_path is not None and \
+                os.path.exists(self._draining_path):
+            return self._write_draining_batch()
+
+        batch = None
+        with self._lock:
+            if self._batch is None and self._writes:
+                # A failed batch is retried as is, with the same token.
+                self._batch = (min(self.batch_size, len(self._writes)),
+                               new_token())
+            if self._batch is not None:
+                size, token = self._batch
+                batch = [self._writes[i] for i in range(size)]
+
+        if batch is not None:
+            self._flush(batch, token)
+            with self._lock:
+                for _ in batch:
+                    self._writes.popleft()
+                self._batch = None
+                self._not_full.notify_all()
+            return True
+
+        with self._lock:
+            if not self._spooling:
+                return False
+            if self._spool_file is not None:
+                self._spool_file.close()
+                self._spool_file = None
+            if not os.path.exists(self.spool_path):
+                self._spooling = False
+                return False
+            # Writes queued from now on go to a new spool file, after the
+            # ones being drained.
+            os.rename(self.spool_path, self._draining_path)
+            self._draining_offset = 0
+        return self._write_draining_batch()
+
+    def _write_draining_batch(self):
+        """Write the next batch of the spool file being drained."""
+        offset = self._write_spool_batch(self._draining_path,
+                                         self._draining_offset)
+        self._draining_offset = offset or 0
+        return True
+
+    def _write_spool_batch(self, path, offset):
+        """Write the batch of the spool file ``path`` starting at ``offset``.
+
+        :rtype: int, the offset of the next batch, ``None`` if the file was
+            written entirely, it is then removed.
+        """
+        batch = []
+        with open(path) as spool:
+            stat = os.fstat(spool.fileno())
+            token = "%x-%x-%x" % (stat.st_ino, int(stat.st_mtime * 1e6),
+                                  offset)
+            spool.seek(offset)
+            while len(batch) < self.batch_size:
+                line = spool.readline()
+                if not line.endswith("\n"):
+                    # End of file, or a line cut by a crash.
+                    break
+                try:
+                    batch.append(json.loads(line))
+                except ValueError:
+                    logger.warning("Skipping corrupted write: %r", line)
+            next_offset = spool.tell()
+
+        if next_offset == offset:
+            os.remove(path)
+            return None
+
+        if batch:
+            self._flush(batch, token)
+        return next_offset
+
+    def _flush(self, batch, token):
+        """Write ``batch``, one pipeline per namespace."""
+        changes = collections.OrderedDict()
+        for write in batch:
+            kind, namespace, id_ = write[:3]
+            unit_of_work = changes.get(namespace)
+            if unit_of_work is None:
+                unit_of_work = changes[namespace] = UnitOfWork()
+                unit_of_work.token = token
+
+            if kind == STATE:
+                unit_of_work.transition(id_, write[4], write[3])
+            elif kind == PROGRESS:
+                unit_of_work.increment(id_, write[3], write[4])
+            elif kind == DELETE:
+                unit_of_work.delete(id_, write[3])
+            else:
+                raise ValueError("Unknown write: '%s'" % kind)
+
+        for namespace, unit_of_work in changes.items():
+            backend = self.backend
+            if namespace != backend.settings.get("namespace"):
+                backend = backend.for_namespace(namespace)
+            backend.flush_changes(unit_of_work)
@@ -0,0 +1,188 @@
+"""
+A WSGI application serving job progress as JSON.
+
+- ``GET /<id>`` returns a job,
+- ``GET /?state=STARTED`` or ``GET /?is_ready=false`` returns a list of
+  jobs.
+
+Responses carry an ``ETag``, the version counter of the job for single
+jobs. Snapshots are cached in the process for ``cache_ttl`` seconds, after
+which a job's snapshot is only read again if its version changed, so
+polling clients mostly cost a single version read and get
+``304 Not Modified`` answers::
+
+    from job_progress.wsgi import ProgressApp
+
+    application = ProgressApp(session, cache_ttl=1)
+"""
+from __future__ import absolute_import
+import hashlib
+import json
+import threading
+import time
+
+try:
+    from urllib.parse import parse_qs
+except ImportError:  # Python 2
+    from urlparse import parse_qs
+
+STATUSES = {
+    200: "200 OK",
+    304: "304 Not Modified",
+    400: "400 Bad Request",
+    404: "404 Not Found",
+    405: "405 Method Not Allowed",
+}
+
+
+class _CacheEntry(object):
+
+    __slots__ = ("version", "etag", "body", "checked_at")
+
+    def __init__(self, version, etag, body, checked_at):
+        self.version = version
+        self.etag = etag
+        self.body = body
+        self.checked_at = checked_at
+
+
+class SnapshotCache(object):
+
+    """
+    Cache of serialized snapshots, shared by every request of the process.
+
+    :param float ttl: amount of seconds during which an entry is served
+        without any backend read.
+    :param int max_size: the cache is emptied when it grows bigger.
+    """
+
+    def __init__(self, ttl=1.0, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the entry for ``key``, ``None`` if unknown."""
+        return self._entries.get(key)
+
+    def is_fresh(self, entry, now=None):
+        """Return True if ``entry`` can be served without checking."""
+        now = time.time() if now is None else now
+        return now - entry.checked_at < self.ttl
+
+    def set(self, key, version, body):
+        """Store a serialized snapshot and return its entry.
+
+        The ETag is the version when there is one, a hash of ``body``
+        otherwise.
+        """
+        if version is not None:
+            etag = '"%s"' % version
+        else:
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+        entry = _CacheEntry(version, etag, body, time.time())
+        with self._lock:
+            if len(self._entries) >= self.max_size:
+                self._entries.clear()
+            self._entries[key] = entry
+        return entry
+
+    def touch(self, entry):
+        """Mark ``entry`` as checked."""
+        entry.checked_at = time.time()
+
+    def delete(self, key):
+        """Forget ``key``."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class ProgressApp(object):
+
+    """
+    WSGI application serving job snapshots.
+
+    :param Session session:
+    :param float cache_ttl: see :class:`SnapshotCache`.
+    """
+
+    def __init__(self, session, cache_ttl=1.0):
+        self.session = session
+        self.cache = SnapshotCache(cache_ttl)
+
+    def __call__(self, environ, start_response):
+        if environ.get("REQUEST_METHOD", "GET") != "GET":
+            return self._respond(start_response, 405)
+
+        id_ = environ.get("PATH_INFO", "").strip("/")
+        if id_:
+            entry = self._get_job(id_)
+        else:
+            try:
+                filters = self._get_filters(environ.get("QUERY_STRING", ""))
+            except ValueError:
+                return self._respond(start_response, 400)
+            entry = self._get_jobs(filters)
+
+        if entry is None:
+            return self._respond(start_response, 404)
+
+        if environ.get("HTTP_IF_NONE_MATCH") == entry.etag:
+            return self._respond(start_response, 304, etag=entry.etag)
+        return self._respond(start_response, 200, entry.body, entry.etag)
+
+    def _get_job(self, id_):
+        """Return the cache entry of a job, ``None`` if it does not exist."""
+        entry = self.cache.get(id_)
+        if entry is not None and self.cache.is_fresh(entry):
+            return entry
+
+        version, = self.session.backend.get_versions(
+            [id_], primary=self.session.is_pinned(id_))
+        if entry is not None and version is not None and \
+                version == entry.version:
+            self.cache.touch(entry)
+            return entry
+
+        snapshot = self.session.snapshot(id_)
+        if snapshot.state is None:
+            self.cache.delete(id_)
+            return None
+
+        body = json.dumps(snapshot.to_dict(), sort_keys=True)
+        return self.cache.set(id_, version, body.encode("utf-8"))
+
+    def _get_jobs(self, filters):
+        """Return the cache entry of a list of jobs."""
+        key = tuple(sorted(filters.items()))
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            return entry
+
+        jobs = [snapshot.to_dict() for snapshot
+                in self.session.iter_snapshots(**filters)]
+        body = json.dumps(jobs, sort_keys=True)
+        return self.cache.set(key, None, body.encode("utf-8"))
+
+    def _get_filters(self, query_string):
+        """Return query filters, raise ValueError if invalid."""
+        filters = {}
+        for name, values in parse_qs(query_string).items():
+            if name == "state":
+                filters["state"] = values[-1]
+            elif name == "is_ready" and values[-1] in ("true", "false"):
+                filters["is_ready"] = values[-1] == "true"
+            else:
+                raise ValueError("Unknown filter: '%s'" % name)
+        return filters
+
+    def _respond(self, start_response, status, body=b"", etag=None):
+        headers = [("Cache-Control", "no-cache")]
+        if etag:
+            headers.append(("ETag", etag))
+        if status == 200:
+            headers.append(("Content-Type", "application/json"))
+        headers.append(("Content-Length", str(len(body))))
+        start_response(STATUSES[status], headers)
+        return [body]
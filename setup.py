@@ -32,7 +32,12 @@ setup(
     author_email='charles@uber.com',
     description='Provide a JobProgress object',
     long_description=read_long_description(),
-    packages=['job_progress'],
+    packages=['job_progress', 'job_progress.backends'],
+    entry_points={
+        'console_scripts': [
+            'job-progress-top = job_progress.top:main',
+        ],
+    },
     include_package_data=True,
     platforms='any',
     test_suite='job_progress.tests',